@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+"""
+For reading AppleSingle and AppleDouble files.
+
+When Mac OS X copies a file to a file system without resource forks,
+it leaves an AppleDouble file named '._' followed by the file's name
+beside it, holding everything about the file but its data fork: its
+Finder info, and its resource fork.  An AppleSingle file holds the
+data fork as well.  Some Mac versions of Eudora keep the mailbox toc
+in the resource fork of the mailbox, so that is where to find it once
+the mail folder has been copied off the Mac.
+
+Only as much of the file is read as is needed: the header and the
+entry descriptors when it's opened, then only the entry asked for.
+In a resource fork, only the resource map, and then only the data of
+the resources of the type asked for.
+
+See notes/AppleSingleDouble.pm for the entry ids.  Resource forks are
+described in 'Inside Macintosh: More Macintosh Toolbox', chapter 1.
+"""
+import os
+from struct import *
+
+# Magic numbers (any other means it's a plain file) and entry ids
+APPLE_SINGLE = 0x00051600
+APPLE_DOUBLE = 0x00051607
+
+DATA_FORK = 1
+RESOURCE_FORK = 2
+
+header = Struct( '>LL16sH' )	# magic, version, filler, number of entries
+descriptor = Struct( '>LLL' )	# entry id, offset, length
+
+# A resource fork begins with the offsets and lengths of its data and
+# of its map.  The map holds the offsets, from the start of the map, of
+# the type list and name list; the type list, a count less one, then
+# the type, count less one and reference list offset of each type; and
+# the reference lists, with the id, name offset (-1 for none) and
+# attributes of each resource, and the 3-byte offset of its data.
+# Each resource's data is preceded by its length.
+
+fork_header = Struct( '>LLLL' )	# data offset, map offset, data len, map len
+map_offsets = Struct( '>24xHH' )	# type list offset, name list offset
+type_entry = Struct( '>4sHH' )	# type, count - 1, reference list offset
+reference = Struct( '>hhL4x' )	# id, name offset, attributes << 24 | data offset
+
+class AppleFileError(Exception):
+	""" Not an AppleSingle or AppleDouble file, or a damaged one.  """
+	pass
+
+class AppleFile:
+	"""
+	An AppleSingle or AppleDouble file, opened for reading.
+	entries maps the id of each entry in it to its ( offset, length ).
+	"""
+	def __init__( self, path ):
+		try:
+			self.file = open( path, 'rb' )
+		except IOError, ( errno, strerror ):
+			raise AppleFileError( strerror )
+		try:
+			data = self.file.read( header.size )
+			if len( data ) < header.size:
+				raise AppleFileError( "not an AppleSingle or AppleDouble file" )
+			( magic, version, filler, count ) = header.unpack( data )
+			if magic == APPLE_SINGLE:
+				self.format = 'AppleSingle'
+			elif magic == APPLE_DOUBLE:
+				self.format = 'AppleDouble'
+			else:
+				raise AppleFileError( "not an AppleSingle or AppleDouble file" )
+
+			data = self.file.read( count * descriptor.size )
+			if len( data ) < count * descriptor.size:
+				raise AppleFileError( "truncated entry descriptors" )
+			self.entries = {}
+			for i in xrange( count ):
+				( id, offset, length ) = descriptor.unpack_from( data,
+							i * descriptor.size )
+				self.entries[id] = ( offset, length )
+		except:
+			self.close()
+			raise
+
+	def close( self ):
+		if self.file:
+			self.file.close()
+			self.file = None
+
+	def read( self, offset, length ):
+		self.file.seek( offset )
+		data = self.file.read( length )
+		if len( data ) < length:
+			raise AppleFileError( "truncated entry" )
+		return data
+
+	def entry( self, id ):
+		"""The contents of entry id, or None if there is no such entry."""
+		try:
+			( offset, length ) = self.entries[id]
+		except KeyError:
+			return None
+		return self.read( offset, length )
+
+	def resources( self, type ):
+		"""
+		Generates the ( id, name, data ) of each resource of the given
+		type (a 4-character string such as 'TOCF') in the resource fork,
+		name being None for an unnamed resource.
+		"""
+		try:
+			( fork, fork_length ) = self.entries[RESOURCE_FORK]
+		except KeyError:
+			return
+		if fork_length < fork_header.size:
+			return
+		( data_offset, map_offset, data_length, map_length ) = \
+			fork_header.unpack( self.read( fork, fork_header.size ) )
+		if ( data_offset + data_length > fork_length
+				or map_offset + map_length > fork_length
+				or map_length < map_offsets.size ):
+			raise AppleFileError( "damaged resource fork" )
+		map = self.read( fork + map_offset, map_length )
+
+		try:
+			( types, names ) = map_offsets.unpack_from( map )
+			count = unpack_from( '>H', map, types )[0] + 1
+			for i in xrange( count ):
+				( t, n, refs ) = type_entry.unpack_from( map,
+						types + 2 + i * type_entry.size )
+				if t != type:
+					continue
+				for j in xrange( n + 1 ):
+					( id, name_offset, offset ) = reference.unpack_from(
+						map, types + refs + j * reference.size )
+					offset &= 0xffffff
+					if offset + 4 > data_length:
+						raise AppleFileError( "damaged resource fork" )
+					name = None
+					if name_offset != -1:
+						at = names + name_offset
+						name = map[at + 1:at + 1 + ord( map[at] )]
+					at = fork + data_offset + offset
+					length = unpack( '>L', self.read( at, 4 ) )[0]
+					if offset + 4 + length > data_length:
+						raise AppleFileError( "damaged resource fork" )
+					yield ( id, name, self.read( at + 4, length ) )
+		except ( error, IndexError ):	# the map points outside itself
+			raise AppleFileError( "damaged resource fork" )
+
+def sidecar( path ):
+	"""The name of the AppleDouble file Mac OS X leaves beside path."""
+	( dir, name ) = os.path.split( path )
+	return os.path.join( dir, '._' + name )
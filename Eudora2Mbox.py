@@ -6,8 +6,13 @@ all the mailboxes it loops over.
 
 Usage:
 
-   Eudora2Mbox.py [-a attachments_folder] [-t target_client] mailbox_file
-   where target_client is either 'pine' or 'kmail'.
+   Eudora2Mbox.py [-a attachments_folder] [-t target_client]
+		[-j workers] [-x attachment_store] mailbox_file
+   where target_client is either 'pine' or 'kmail'.  With -x, attached
+   files are put in the attachment_store directory and referred to from
+   the messages, rather than copied into them; see attachment_store.
+   With -j, a big mailbox is converted in that many pieces at once; see
+   chunk_workers.
 
    Requires Python 2.2+
 
@@ -30,12 +35,13 @@ Altered by Stevan White 11/2001
 * Translated from Perl to Python, for no particularly compelling reason.
   Looks nicer, I think.  Probably a little more robust.
 * Made to include info of whether message was read or not.
-  To do this, made it read a parsed Eudora 'toc' file
-  See collect_toc_info().
+  To do this, made it read the Eudora 'toc' file
+  See TOC_Info in Header.py.
 * Made to convey info that message was replied to.
   Eudora seems to do this by reading the whole mailbox searching for
   'In-Reply-To:' headers, then matching these with 'Message-ID:' headers.
-  So we read through each message file twice.  See collect_replies().
+  These are gathered while the messages are located, so each message
+  file is only read through once.  See Replies in Header.py.
 * Made to do something sensible with Eudora's 'Attachment Converted' lines.
 
 For more info on Internet mail headers, and the quasi-standard 'Status:'
@@ -54,7 +60,22 @@ import re
 import sys
 import string
 import getopt
+import itertools
+import cStringIO
 import urllib
+import shutil
+import tempfile
+import base64
+import hashlib
+import errno
+import time
+import stat
+import threading
+import Queue
+import multiprocessing
+import copy
+import bisect
+import collections
 import traceback
 from HTMLParser import HTMLParseError
 import mimetypes
@@ -63,6 +84,7 @@ import mimetypes
 # library
 
 from email import message, encoders
+from email.generator import Generator
 from email.mime.multipart import MIMEMultipart
 from email.mime.nonmultipart import MIMENonMultipart
 from email.mime.application import MIMEApplication
@@ -70,9 +92,9 @@ from email.mime.text import MIMEText
 from email.mime.image import MIMEImage
 from email.mime.message import MIMEMessage
 from email.mime.audio import MIMEAudio
-from mailbox import mbox, Maildir, MMDF, MH, Babyl
+from mailbox import Maildir, MH, Babyl
 
-from Header import Replies, TOC_Info, Header, strip_linesep, re_message_start
+from Header import Replies, TOC_Info, TOC_Health, Header, strip_linesep, normalize_linesep, line_end, map_mailbox, message_spans, toc_message_spans
 import EudoraLog
 from EudoraHTMLParser import *
 
@@ -109,7 +131,9 @@ from EudoraHTMLParser import *
 # maybe 10% by reducing number of string copies, but to compare 
 # collect_replies and convert, seems the former takes just about half
 # what the latter takes, but the former does much less processing--
-# but it only reads, while the latter reads and writes.
+# but it only reads, while the latter reads and writes.  So the
+# separate collect_replies pass is gone; its work is now folded into
+# finding the message boundaries.
 
 # (everything else too small to report)
 
@@ -117,6 +141,21 @@ from EudoraHTMLParser import *
 # regexp that should have just checked the first few chars, but it was
 # substantially slower than the string native find.
 
+# Reading line by line with readline() and tell() turned out to
+# dominate the run time on multi-gigabyte mailboxes.  The mailbox is
+# now memory-mapped and scanned for message boundaries with that same
+# native find; see message_spans() in Header.py.
+
+# On plain text mailboxes, most of what was left went into building
+# email.message objects for messages that needed nothing done to them
+# but their 'From ' line and a few status headers, only for the mailbox
+# to flatten them again.  Those are now written out as they were; see
+# passthrough_message().  On 20,000 such messages this took the run
+# from 5.8 seconds to 3.4.  Writing mbox and MMDF files with MboxWriter
+# rather than the mailbox module, which flushes the file after every
+# message, took the same messages built up as email.message objects
+# from 5.8 seconds to 4.8.
+
 if sys.hexversion < 33686000:
 	sys.stderr.write( "Aborted: Python version must be at least 2.2.1" \
 		+ os.linesep )
@@ -127,13 +166,12 @@ P = sys.argv[0]
 
 exit_code = 0	# exit code: 0 if all ok, 1 if any warnings or errors
 
-message_count = 0
-
 re_x_attachment = re.compile( r'^X-Attachments: (.*)$', re.IGNORECASE )
 re_quoted_attachment = re.compile( r'^Attachment converted: "([^"]*)"\s*$', re.IGNORECASE )
 re_attachment = re.compile( r'^Attachment converted: (.*)$', re.IGNORECASE )
 re_embedded = re.compile( r'^Embedded Content: ([^:]+):.*' )
 re_mangled_mac = re.compile( r'#[0-9a-zA-Z]{5}\.[^.]+$' )
+re_mangled_mac_parts = re.compile( r'^(.*)#[0-9a-zA-Z]{5}\.([^.]+)$' )
 re_rfc822 = re.compile( r'message/rfc822', re.IGNORECASE )
 re_multi_contenttype = re.compile( r'multipart/([^;]+);.*', re.IGNORECASE )
 re_single_contenttype = re.compile( r'^([^/]+)/([^;]+);?.*', re.IGNORECASE )
@@ -154,23 +192,190 @@ re_dos_path_beginning = re.compile( r'.*:\\.*' )
 
 re_initial_whitespace = re.compile( r'^[ \t]+(.*?)$' )
 
+def caseless( text ):
+	"""Spells out text as a case-insensitive regular expression, for
+	the parts of a pattern that has to be case-sensitive elsewhere."""
+
+	return ''.join( [ c.isalpha() and '[' + c.upper() + c.lower() + ']' or re.escape( c ) for c in text ] )
+
+# scrub_body() finds everything it needs in a body with one combined
+# scan, in place of the line-by-line matching against the patterns
+# above.  Every match begins with a '<' or a newline, so the regular
+# expression engine can skip ahead to those; the 'Attachment Converted'
+# and 'Embedded Content' lines are the ones after a newline, and '.'
+# never crosses one, so each match stays within the one line the old
+# patterns would have been tried against.  A line of that kind at the
+# very start of a block has no newline before it, and is looked for
+# separately.
+
+body_markup = r'(?<=<)(?:(?P<xhtml>/?' + caseless( 'x-html' ) + r'>)' \
+	r'|(?P<markup>/?x-flowed>|!x-stuff-for-pete[^>\n]+>)' \
+	r'|(?P<html>/?' + caseless( 'html' ) + r'>))'
+body_embedded = r'(?P<embedded>Embedded Content: (?P<filename>[^:\n]+):.*)'
+body_attachment = r'(?P<attachment>' + caseless( 'Attachment converted: ' ) + r'.*)'
+re_body_scan = re.compile( r'[<\n](?:' + body_markup + r'|(?<=\n)' + body_embedded + ')' )
+re_body_scan_attachments = re.compile( r'[<\n](?:' + body_markup \
+	+ r'|(?<=\n)(?:' + body_embedded + '|' + body_attachment + '))' )
+re_body_first_line = re.compile( body_embedded )
+re_body_first_line_attachments = re.compile( body_embedded + '|' + body_attachment )
+re_body_markup = re.compile( r'</?x-flowed>|</?' + caseless( 'x-html' ) \
+	+ r'>|<!x-stuff-for-pete[^>\n]+>' )
+
+re_prefetch_refs = re.compile( r'(?<![^\r\n])(?:(' + caseless( 'Attachment converted: ' ) \
+	+ r'[^\r\n]*)|' + caseless( 'X-Attachments: ' ) + r'([^\r\n]*)' \
+	+ r'|Embedded Content: ([^:\r\n]+):)' )
+re_spooled_body = re.compile( '(\0Eudora2Mbox spooled (?:body|attachment) \d+\0)' )
+re_eight_bit = re.compile( '[\x80-\xff]' )
+
 mimetypes.init()
 
 scrub_xflowed = True
-attachments_listed = 0
-attachments_found = 0
-attachments_missing = 0
-paths_found = {}
-paths_missing = {}
-missing_attachments = {}
-found_attachments = {}
+
+# Messages longer than spool_threshold bytes are converted a chunk at a
+# time, with their bodies kept in temporary files rather than in
+# memory, so that a huge inline uuencoded or binhex body doesn't end up
+# held several times over.
+
+spool_threshold = 16 * 1024 * 1024
+spool_chunk = 1024 * 1024
+spooled_bodies = {}
 attachments_dirs = []
-mac_mismatches = []
+
+# The names in each directory attachments are looked for in, listed the
+# first time it's looked in, so that trying the several names an
+# attachment may have been saved under (see handle_attachment()) costs
+# a dictionary lookup each, not a stat call each, for every directory.
+# The attachment directories don't change while we convert.
+
+attachment_listings = {}
+
+# Likewise the files in the directory embedded content is kept in (the
+# Embedded directory on Windows, the Parts Folder on the Mac), with the
+# stat() and guessed MIME type of each, so that craft_message() and
+# handle_embedded() find them with no stat calls of their own.
+
+embedded_indexes = {}
+
+# Mac Eudora shortens long attachment names, as in 'IRD Projec REVIEWS
+# sc#D8D4B.xls', where the '#D8D4B' is the file's inode number, of no
+# use once the files have been copied elsewhere (see notes.txt).  For
+# each set of attachment directories, mac_name_indexes keeps the files
+# in them by extension, each extension's in a list sorted by lower-case
+# name, so those beginning as the shortened name does are found with a
+# binary search, however many files there are.  See mac_name_candidates().
+
+mac_name_indexes = {}
+
+mac_name_range_limit = 10000	# candidates beyond this are too vague to rank
+
+# Encoded attachment parts, so that a file attached to many messages is
+# read and encoded once.  They're keyed by the file's path, size and
+# modification time, in case it changes, and the least recently used
+# are dropped once the cache holds more than part_cache_limit bytes of
+# encoded data.  Each use gets a copy, for its own Content-Disposition.
+
+part_classes = { 'application': MIMEApplication, 'video': MIMEApplication,
+	'image': MIMEImage, 'text': MIMEText, 'audio': MIMEAudio }
+part_cache = collections.OrderedDict()
+part_cache_size = 0
+part_cache_limit = 64 * 1024 * 1024
+
+# Files bigger than stream_threshold are attached as a StreamedAttachment
+# instead, encoded a stream_chunk at a time as the message is written
+# out, so that memory use doesn't grow with the size of the file.  They
+# aren't cached.  stream_chunk is a whole number of 57-byte base64 lines.
+
+stream_threshold = 4 * 1024 * 1024
+stream_chunk = 57 * 16 * 1024
+
+# A Prefetcher's prefetch_threads threads find and read the files
+# attached to and embedded in the next prefetch_ahead messages while
+# the current one is converted, so that with the attachments on a slow
+# (say NFS-mounted) file system, the conversion isn't left waiting on
+# each file in turn.  They hold no more than prefetch_limit bytes of
+# file data at a time.  They only save time: which files a message
+# gets, and what goes in it, is decided one message at a time as
+# before, so the output is the same.
+
+prefetch_threads = 4
+prefetch_ahead = 16
+prefetch_limit = 32 * 1024 * 1024
+prefetcher = None
+
+# With -x, files are left out of the messages altogether: each one is
+# hard linked (or, failing that, copied) into the attachment_store
+# directory under the SHA-1 of its contents, so that a file attached
+# many times, under whatever names, is stored once, and the message
+# gets a message/external-body part (RFC 2046) naming the stored copy
+# as a local file.  The digests are kept by path, size and modification
+# time, like part_cache, so that a file isn't read again to find it.
+
+attachment_store = None
+store_digests = {}
+
+# Given -j, a mailbox bigger than chunk_threshold bytes is split at
+# message boundaries into chunk_workers runs of messages of about the
+# same size, each converted by a worker process into a file of its own,
+# and the files are joined in order; see convert_chunks().  The
+# messages are located and the In-Reply-To ids collected beforehand, in
+# one pass over the whole mailbox as ever, so that a message answered
+# by one in another chunk still gets its X-Status A.  Only mbox and
+# MMDF mailboxes, each a single file, are split.
+
+chunk_workers = 1
+chunk_threshold = 256 * 1024 * 1024
 
 target = None
 toc_info = None
 replies = None
 edir = None
+line_sep = '\n'	# '\r' in a Mac Eudora mailbox; see line_end() in Header.py
+
+class Conversion:
+	"""
+	What converting mailboxes turns up, for the report Eudora2Unix.py
+	writes to attachlog.txt: how many messages and attachments there
+	were, the attachments found and missing in each mailbox, and so on.
+
+	convert() adds to the module's conversion.  Mailboxes converted in
+	worker processes (see convert_worker()) each send their own back,
+	to be merge()d into the one the report is made from.
+	"""
+
+	def __init__( self ):
+		self.message_count = 0
+		self.attachments_listed = 0
+		self.attachments_found = 0
+		self.attachments_missing = 0
+		self.paths_found = {}		# path given: count
+		self.paths_missing = {}
+		self.found_attachments = {}	# mailbox: [ ( description, file ) ]
+		self.missing_attachments = {}	# mailbox: [ description ]
+		self.mac_mismatches = []
+		self.mac_candidates = {}	# mangled name: the likeliest files
+		self.part_cache_hits = 0
+		self.part_cache_misses = 0
+		self.store_added = 0
+		self.store_reused = 0
+
+	def merge( self, other ):
+		for name in ( 'message_count', 'attachments_listed',
+				'attachments_found', 'attachments_missing',
+				'part_cache_hits', 'part_cache_misses',
+				'store_added', 'store_reused' ):
+			setattr( self, name, getattr( self, name ) + getattr( other, name ) )
+		for ( counts, more ) in ( ( self.paths_found, other.paths_found ),
+				( self.paths_missing, other.paths_missing ) ):
+			for ( path, count ) in more.iteritems():
+				counts[path] = counts.get( path, 0 ) + count
+		for ( lists, more ) in ( ( self.found_attachments, other.found_attachments ),
+				( self.missing_attachments, other.missing_attachments ) ):
+			for ( mbx, items ) in more.iteritems():
+				lists.setdefault( mbx, [] ).extend( items )
+		self.mac_mismatches.extend( other.mac_mismatches )
+		self.mac_candidates.update( other.mac_candidates )
+
+conversion = Conversion()
 
 def convert( mbx, embedded_dir = None, opts = None ):
 	"""
@@ -196,20 +401,15 @@ def convert( mbx, embedded_dir = None, opts = None ):
 
 	"""
 
-	global attachments_listed, attachments_found, attachments_missing, attachments_dirs
-
-	global paths_found, paths_missing, message_count
-
 	global re_initial_whitespace
 
-	global toc_info, replies, target
-	global edir
-
-	attachments_listed = 0
-	attachments_found = 0
-	attachments_missing = 0
+	global toc_info, replies, line_sep
 
-	edir = embedded_dir
+	( listed, found, missing ) = ( conversion.attachments_listed,
+		conversion.attachments_found, conversion.attachments_missing )
+	( encoded, reused ) = ( conversion.part_cache_misses,
+		conversion.part_cache_hits )
+	( added, already ) = ( conversion.store_added, conversion.store_reused )
 
 	print "Converting %s" % (mbx,)
 
@@ -217,23 +417,12 @@ def convert( mbx, embedded_dir = None, opts = None ):
 		EudoraLog.fatal( P + ': usage: Eudora2Mbox.py eudora-mailbox-file.mbx' )
 		return 0
 
-	attachments_dirs = []
-	target = ''
-	format = None
-
-	if opts:
-		for f, v in opts:
-			if f == '-a':
-				attachments_dirs = v.split(':')
-			elif f == '-f':
-				format = v.strip().lower()
-			elif f == '-t':
-				target = v
+	format = convert_options( embedded_dir, opts )
 
 	EudoraLog.log = EudoraLog.Log( mbx )
 
 	try:
-		INPUT = open( mbx, 'r' )
+		INPUT = open( mbx, 'rb' )
 	except IOError, ( errno, strerror ):
 		INPUT = None
 		return EudoraLog.fatal( P + ': cannot open "' + mbx + '", ' + strerror )
@@ -243,55 +432,49 @@ def convert( mbx, embedded_dir = None, opts = None ):
 	newmailbox = create_mailbox( newfile, format )
 
 	toc_info = TOC_Info( mbx )
-	replies = Replies( INPUT )
-
-	headers = None
-	last_file_position = 0
-	msg_offset = 0
-	msg_lines = []
-	attachments = []
-	embeddeds = []
-	message = None
+	replies = Replies()
 
 	EudoraLog.msg_no	= 0	# number of messages in this mailbox
 	EudoraLog.line_no	= 0	# line number of current line record (for messages)
 
-	# Main loop, that reads the mailbox file and converts.
+	# Main loop, that converts the messages found in the mailbox.
 	#
-	# Sad issues with the nice python construct
-	#	for line in INPUT:
-	# It appears to read the whole file into an array before executing
-	# the loop!  Besides being grotesquely inefficient, it blows up the
-	# use of tell() within the loop.  See
-	# <http://www.python.org/peps/pep-0234.html>
-	while True:
-		line = INPUT.readline()
-
-		if msg_lines and (not line or re_message_start.match( line )):
-
-			(headers, body, attachments, embeddeds, mbx, is_html) = extract_pieces(msg_lines, last_file_position, mbx)
-
-			message = craft_message(headers, body, attachments, embeddeds, mbx, is_html)
-
-			try:
-				message_count = message_count + 1
-				newmailbox.add(message)
-			except TypeError:
-				print str(headers)
-				print message.get_content_type()
-				traceback.print_exc(file=sys.stdout)
-
-			EudoraLog.msg_no = EudoraLog.msg_no + 1
-			msg_offset = last_file_position
-
-			msg_lines = []
-
-		if not line:
-			break
+	# The mailbox is memory-mapped.  Where there is a toc, its offsets
+	# and lengths tell us where the messages are, and are only checked
+	# against the 'From ' lines they should point at; otherwise, and
+	# for any part of the mailbox the toc gets wrong, message_spans()
+	# locates the messages with a byte search for 'From' at the start
+	# of a line, so we no longer readline() and tell() our way through
+	# the file matching re_message_start against every line.  A toc
+	# that disagrees with the mailbox (see TOC_Health) isn't used,
+	# neither for the spans nor for Status and X-Priority.  The
+	# In-Reply-To ids are collected from the headers of each message
+	# while the spans are found, so the mailbox isn't read through a
+	# second time beforehand just to learn which messages were answered.
+	# The messages are then converted by convert_spans(), or for a big
+	# enough mailbox, split among worker processes by convert_chunks().
+
+	mailbox = map_mailbox( INPUT )
+	line_sep = line_end( mailbox, 0, len( mailbox ) )
+
+	if toc_info.info:
+		toc_spans = toc_info.spans()
+		health = TOC_Health( mailbox, toc_spans )
+		if not health.trusted():
+			EudoraLog.log.warn( "not using the toc, which doesn't "
+				+ "agree with the mailbox: " + str( health ) )
+			toc_info.distrust()
+	if toc_info.info:
+		spans = toc_message_spans( mailbox, toc_spans, replies )
+	else:
+		spans = message_spans( mailbox, replies = replies )
 
-		msg_lines.append(strip_linesep(line) + "\n")
-		last_file_position = INPUT.tell()
-		EudoraLog.line_no += 1
+	if ( chunk_workers > 1 and len( spans ) > 1
+			and len( mailbox ) > chunk_threshold
+			and isinstance( newmailbox, MboxWriter ) ):
+		convert_chunks( mbx, embedded_dir, opts, spans, newmailbox, newfile, format )
+	else:
+		convert_spans( mbx, mailbox, spans, newmailbox )
 
 	# Check if the file isn't empty and any messages have been processed.
 	if EudoraLog.line_no == 0:
@@ -304,16 +487,20 @@ def convert( mbx, embedded_dir = None, opts = None ):
 
 		print "\nMissing path count:"
 
-		for (path, count) in paths_missing.iteritems():
+		for (path, count) in conversion.paths_missing.iteritems():
 			print "%s: %d" % (path, count)
 
 		print "\nFound path count:"
 
-		for (path, count) in paths_found.iteritems():
+		for (path, count) in conversion.paths_found.iteritems():
 			print "%s: %d" % (path, count)
  
 	print "\n------------------------------"
-	print "Attachments Listed: %d\nAttachments Found: %d\nAttachments Missing:%d" % (attachments_listed, attachments_found, attachments_missing)
+	print "Attachments Listed: %d\nAttachments Found: %d\nAttachments Missing:%d" % (conversion.attachments_listed - listed, conversion.attachments_found - found, conversion.attachments_missing - missing)
+	if attachment_store:
+		print "Attachment Files Stored: %d\nAttachment Files Already Stored: %d" % (conversion.store_added - added, conversion.store_reused - already)
+	else:
+		print "Attachment Files Encoded: %d\nAttachment Files Reused: %d" % (conversion.part_cache_misses - encoded, conversion.part_cache_hits - reused)
 	print "------------------------------"
 
 	if EudoraLog.msg_no == 0: msg_str = 'total: Converted no messages' 
@@ -330,6 +517,9 @@ def convert( mbx, embedded_dir = None, opts = None ):
 	if newmailbox:
 		newmailbox.close()
 
+	if mailbox:
+		mailbox.close()
+
 	if INPUT:
 		try:
 			INPUT.close()
@@ -338,6 +528,538 @@ def convert( mbx, embedded_dir = None, opts = None ):
 
 	return 0
 
+def convert_options( embedded_dir, opts ):
+	"""Sets the module's settings for converting a mailbox from the
+	arguments to convert(), and returns the mailbox format asked for."""
+
+	global attachments_dirs, attachment_store, target, edir, chunk_workers
+
+	edir = embedded_dir
+
+	attachments_dirs = []
+	attachment_store = None
+	target = ''
+	format = None
+	chunk_workers = 1
+
+	if opts:
+		for f, v in opts:
+			if f == '-a':
+				attachments_dirs = v.split(':')
+			elif f == '-f':
+				format = v.strip().lower()
+			elif f == '-j':
+				chunk_workers = int( v )
+			elif f == '-t':
+				target = v
+			elif f == '-x':
+				attachment_store = os.path.abspath( v )
+
+	return format
+
+def convert_spans( mbx, mailbox, spans, newmailbox ):
+	"""Converts the messages at spans, a list of ( offset, length ),
+	in the mapped mailbox mbx, adding them to newmailbox."""
+
+	global prefetcher
+
+	if prefetch_threads and ( attachments_dirs or edir ):
+		prefetcher = Prefetcher( prefetch_threads, prefetch_limit )
+
+	# Closed however the loop ends, so that a message that fails to
+	# convert doesn't leave it for the next mailbox to take() from.
+	try:
+		for ( i, ( offset, length ) ) in enumerate( spans ):
+			if prefetcher:
+				if i == 0:
+					ahead = spans[:prefetch_ahead]
+				else:
+					ahead = spans[i + prefetch_ahead - 1:i + prefetch_ahead]
+				for span in ahead:
+					prefetcher.submit( mailbox, span )
+
+			spool = length > spool_threshold
+
+			if spool:
+				msg_chunks = spooled_span_chunks( mailbox, offset, length )
+			else:
+				msg_chunks = [ normalize_linesep( mailbox[offset:offset + length], line_sep ) ]
+				EudoraLog.line_no += msg_chunks[0].count( '\n' )
+
+			# Messages that need no rewriting are passed through
+			# to the mailbox as they are; see passthrough_message()
+
+			if not spool and isinstance( newmailbox, MboxWriter ):
+				raw = RawHeaders()
+			else:
+				raw = None
+
+			(headers, body, attachments, embeddeds, mbx, is_html) = extract_pieces(msg_chunks, offset, mbx, spool=spool, raw=raw)
+
+			message = None
+
+			if raw:
+				message = passthrough_message(raw, msg_chunks[0], headers, body, attachments, embeddeds, is_html)
+
+			if message:
+				print "R",
+			else:
+				message = craft_message(headers, body, attachments, embeddeds, mbx, is_html)
+
+			try:
+				conversion.message_count = conversion.message_count + 1
+				if spooled_bodies:
+					spooled_message = SpooledMessage(message)
+					try:
+						newmailbox.add(spooled_message)
+					finally:
+						spooled_message.close()
+				else:
+					newmailbox.add(message)
+			except TypeError:
+				print str(headers)
+				print message.get_content_type()
+				traceback.print_exc(file=sys.stdout)
+
+			for spooled_body in spooled_bodies.values():
+				spooled_body.close()
+			spooled_bodies.clear()
+
+			if prefetcher:
+				prefetcher.release( offset )
+
+			EudoraLog.msg_no = EudoraLog.msg_no + 1
+	finally:
+		if prefetcher:
+			prefetcher.close()
+			prefetcher = None
+
+def split_spans( spans, n ):
+	"""Splits spans into at most n runs of consecutive spans, of
+	about the same number of bytes each."""
+
+	total = sum( [ length for ( offset, length ) in spans ] )
+	runs = []
+	start = 0
+	size = 0
+	for ( i, ( offset, length ) ) in enumerate( spans ):
+		size += length
+		if size * n >= total * ( len( runs ) + 1 ) and i + 1 < len( spans ):
+			runs.append( spans[start:i + 1] )
+			start = i + 1
+	runs.append( spans[start:] )
+	return runs
+
+def convert_chunks( mbx, embedded_dir, opts, spans, newmailbox, newfile, format ):
+	"""
+	Converts the messages at spans in mailbox mbx with a pool of
+	chunk_workers worker processes, each converting a run of them into
+	a file of its own (see convert_chunk()), then copies the files onto
+	newmailbox in order.  The workers' logs are added to the mailbox's,
+	what they printed is printed, and what they found is merged into
+	conversion, all in the same order, and the message and line counts
+	are brought up to date, as if the messages had been converted one
+	after another here.  The exception is the part cache counts: each
+	worker has a part_cache of its own, so a file attached to messages
+	in different runs is encoded by each worker, not reused.
+
+	The lines before each run are counted first, also by the workers,
+	so that the line numbers in the logs are those of a single pass.
+	"""
+	chunks = split_spans( spans, chunk_workers )
+	paths = [ '%s.%d' % ( newfile, k ) for k in range( len( chunks ) ) ]
+
+	pool = multiprocessing.Pool( chunk_workers )
+	try:
+		try:
+			lines = pool.map( count_lines, [ ( mbx, chunk ) for chunk in chunks ] )
+
+			jobs = []
+			( msg_no, line_no ) = ( EudoraLog.msg_no, EudoraLog.line_no )
+			for ( chunk, count, path ) in zip( chunks, lines, paths ):
+				jobs.append( ( mbx, embedded_dir, opts, chunk, replies,
+					toc_info.info is not None, msg_no, line_no, format, path ) )
+				msg_no += len( chunk )
+				line_no += count
+
+			results = pool.map( convert_chunk, jobs )
+			pool.close()
+		except:
+			pool.terminate()
+			raise
+		finally:
+			pool.join()
+
+		for ( ( found, log, softspace ), path ) in zip( results, paths ):
+			conversion.merge( found )
+			EudoraLog.log.join( log )
+			newmailbox.join( path )
+			output = open( path + '.out', 'r' )
+			try:
+				# the space print would have put between
+				# the last item before and the first here
+				text = output.read( spool_chunk )
+				if text:
+					if sys.stdout.softspace and text[0] != '\n':
+						sys.stdout.write( ' ' )
+					while text:
+						sys.stdout.write( text )
+						text = output.read( spool_chunk )
+					sys.stdout.softspace = softspace
+			finally:
+				output.close()
+		( EudoraLog.msg_no, EudoraLog.line_no ) = ( msg_no, line_no )
+	finally:
+		for path in paths:
+			for name in ( path, path + '.out' ):
+				if os.path.exists( name ):
+					os.remove( name )
+
+def count_lines( args ):
+	"""
+	The number of lines convert_spans() counts in the messages at
+	spans in mailbox mbx, given ( mbx, spans ), in a worker process.
+	normalize_linesep() leaves the line separators as they are, only
+	adding one to a message lacking a last one, so they can be counted
+	in the mailbox as it is, a spool_chunk at a time.
+	"""
+	( mbx, spans ) = args
+
+	INPUT = open( mbx, 'rb' )
+	try:
+		mailbox = map_mailbox( INPUT )
+		nl = line_end( mailbox, 0, len( mailbox ) )
+		lines = 0
+		for ( offset, length ) in spans:
+			end = offset + length
+			for start in xrange( offset, end, spool_chunk ):
+				lines += mailbox[start:min( start + spool_chunk, end )].count( nl )
+			if length and mailbox[end - 1] != nl:
+				lines += 1
+		if mailbox:
+			mailbox.close()
+	finally:
+		INPUT.close()
+
+	return lines
+
+def convert_chunk( args ):
+	"""
+	Converts a run of the messages of a mailbox split up by
+	convert_chunks(), in a worker process, given ( mbx, embedded_dir,
+	opts, spans, replies, trusted, msg_no, line_no, format, path ):
+	where the messages are, the Replies of the whole mailbox, whether
+	its toc is to be used, how many messages and lines come before
+	these, and the mailbox file to write them to.  Returns the
+	Conversion of these messages, their EudoraLog.Log, whose files are
+	named after path, and whether print was left owing a space.  What's
+	printed meanwhile goes to path + '.out', for convert_chunks() to
+	print in order, rather than in among what the other workers print.
+	"""
+	global conversion, toc_info, replies, line_sep
+
+	( mbx, embedded_dir, opts, spans, replies, trusted,
+		msg_no, line_no, format, path ) = args
+
+	output = open( path + '.out', 'w' )
+	( stdout, sys.stdout ) = ( sys.stdout, output )
+	try:
+		conversion = Conversion()
+		convert_options( embedded_dir, opts )
+
+		EudoraLog.log = EudoraLog.Log( mbx, path )
+		EudoraLog.msg_no = msg_no
+		EudoraLog.line_no = line_no
+
+		toc_info = TOC_Info( mbx, trusted )
+
+		INPUT = open( mbx, 'rb' )
+		try:
+			mailbox = map_mailbox( INPUT )
+			line_sep = line_end( mailbox, 0, len( mailbox ) )
+			newmailbox = create_mailbox( path, format )
+			try:
+				convert_spans( mbx, mailbox, spans, newmailbox )
+			finally:
+				newmailbox.close()
+				mailbox.close()
+		finally:
+			INPUT.close()
+	finally:
+		sys.stdout = stdout
+		softspace = output.softspace
+		output.close()
+
+	return ( conversion, EudoraLog.log, softspace )
+
+def spooled_span_chunks( mailbox, offset, length ):
+	"""Generates the message at offset in the mapped mailbox as a
+	series of normalized chunks of about spool_chunk bytes, each
+	ending with a newline, so that a very large message is never
+	copied out of the mailbox all at once."""
+
+	end = offset + length
+
+	while offset < end:
+		chunk_end = offset + spool_chunk
+
+		if chunk_end < end:
+			eol = mailbox.find( line_sep, chunk_end - 1, end )
+			if eol == -1:
+				chunk_end = end
+			else:
+				chunk_end = eol + 1
+		else:
+			chunk_end = end
+
+		chunk = normalize_linesep( mailbox[offset:chunk_end], line_sep )
+		EudoraLog.line_no += chunk.count( '\n' )
+
+		yield chunk
+
+		offset = chunk_end
+
+class SpooledBody:
+	"""Stands in for the list of body text of a message longer than
+	spool_threshold, writing the text out to a temporary file.
+
+	extract_pieces() drops the blank line Eudora puts before an
+	'Attachment Converted' line with drop_blank_line(), so trailing
+	newlines are held back until more text is appended.
+
+	craft_message() uses the token in place of the body text while
+	it builds the message, and SpooledMessage swaps the body back in
+	when the message is written out."""
+
+	def __init__( self ):
+		self.file = tempfile.TemporaryFile()
+		self.written = False
+		self.newlines = 0
+		self.eight_bit = False
+		self.token = '\0Eudora2Mbox spooled body %d\0' % ( len( spooled_bodies ), )
+		spooled_bodies[self.token] = self
+
+	def __iter__( self ):
+		self.file.flush()
+		self.file.seek( 0 )
+		newlines = self.newlines
+		for line in self.file:
+			if not line.endswith( '\n' ):
+				# the last line, its newline held back
+				line = line + '\n'
+				newlines = newlines - 1
+			yield line
+		for i in range( newlines ):
+			yield '\n'
+
+	def append( self, text ):
+		content = text.rstrip( '\n' )
+		if content:
+			self.file.write( '\n' * self.newlines )
+			self.file.write( content )
+			self.written = True
+			self.newlines = len( text ) - len( content )
+			if not self.eight_bit and re_eight_bit.search( content ):
+				self.eight_bit = True
+		else:
+			self.newlines = self.newlines + len( text )
+
+	def drop_blank_line( self ):
+		if self.newlines > 1 or ( self.newlines == 1 and not self.written ):
+			self.newlines = self.newlines - 1
+
+	def copy_to( self, out ):
+		self.file.flush()
+		self.file.seek( 0 )
+		shutil.copyfileobj( self.file, out, spool_chunk )
+		out.write( '\n' * self.newlines )
+
+	def close( self ):
+		self.file.close()
+
+class StreamedAttachment:
+	"""Stands in for the base64 payload of a file attached to a
+	message, encoding the file into the mailbox when the message is
+	written out rather than holding it all in memory.
+
+	The payload is registered with the spooled bodies, so the message
+	goes out as a SpooledMessage, which calls copy_to() in place of
+	the token.  What's written is what email.encoders.encode_base64()
+	would have made of the file, byte for byte."""
+
+	def __init__( self, path ):
+		self.path = path
+		self.token = '\0Eudora2Mbox spooled attachment %d\0' % ( len( spooled_bodies ), )
+		spooled_bodies[self.token] = self
+
+	def part( self, mimetype, mimesubtype ):
+		part = MIMENonMultipart( mimetype, mimesubtype )
+		part.set_payload( self.token )
+		part['Content-Transfer-Encoding'] = 'base64'
+		return part
+
+	def copy_to( self, out ):
+		fp = open( self.path, 'rb' )
+		try:
+			encoded = ''
+			last = ''
+			while True:
+				chunk = fp.read( stream_chunk )
+				if not chunk:
+					break
+				out.write( encoded )
+				encoded = base64.encodestring( chunk )
+				last = chunk[-1]
+			# encode_base64() drops the trailing newline unless
+			# the file itself ended with one
+			if last != '\n':
+				encoded = encoded[:-1]
+			out.write( encoded )
+		finally:
+			fp.close()
+
+	def close( self ):
+		pass
+
+class SpooledMessage:
+	"""A message with spooled bodies, flattened into a temporary file
+	so that it can be handed to the mailbox as a file rather than as
+	an email.message object.  Mailboxes copy such files over,
+	quoting 'From ' lines as they go where the format calls for it,
+	just as they would have quoted the flattened message."""
+
+	def __init__( self, message ):
+		self.unixfrom = message.get_unixfrom()
+		self.file = tempfile.TemporaryFile()
+
+		flattened = cStringIO.StringIO()
+		Generator( flattened, False, 0 ).flatten( message )
+
+		for piece in re_spooled_body.split( flattened.getvalue() ):
+			if piece in spooled_bodies:
+				spooled_bodies[piece].copy_to( self.file )
+			else:
+				self.file.write( piece )
+
+		self.file.seek( 0 )
+
+	def readline( self, size = -1 ):
+		return self.file.readline( size )
+
+	def read( self, size = -1 ):
+		return self.file.read( size )
+
+	def close( self ):
+		self.file.close()
+
+class MboxWriter:
+	"""An append-only mbox or MMDF file.
+
+	The mailbox module's mbox and MMDF classes keep a table of
+	contents for the whole file, seek to its end and flush it for
+	every message added, and only take messages as email.message
+	objects, strings or files.  We never read the file back, so this
+	writes the messages out one after another through a large
+	buffer instead.  Messages passthrough_message() made into a list
+	of pieces of text are written out as they are, with 'From '
+	lines quoted a piece at a time rather than a line at a time.
+
+	The file written is the same as the mailbox module would write,
+	byte for byte."""
+
+	def __init__( self, path, mmdf = False ):
+		self.file = open( path, 'ab', 1024 * 1024 )
+		self.mmdf = mmdf
+
+	def add( self, message ):
+		if self.mmdf:
+			self.file.write( '\001\001\001\001' + os.linesep )
+
+		if isinstance( message, list ):
+			# the 'From ' line, then pieces each ending with a newline
+			self.file.write( message[0].replace( '\n', os.linesep ) )
+			for piece in message[1:]:
+				self.write( quote_from( piece ) )
+		elif isinstance( message, SpooledMessage ):
+			self.file.write( message.unixfrom + os.linesep )
+			self.copy( message )
+		else:
+			unixfrom = message.get_unixfrom()
+			if unixfrom is None:
+				unixfrom = 'From MAILER-DAEMON %s' % time.asctime( time.gmtime() )
+			self.file.write( unixfrom + os.linesep )
+
+			flattened = cStringIO.StringIO()
+			Generator( flattened, True, 0 ).flatten( message )
+			data = flattened.getvalue()
+			self.write( data )
+			if not data.endswith( '\n' ) and not self.mmdf:
+				self.file.write( os.linesep )
+
+		if self.mmdf:
+			self.file.write( os.linesep + '\001\001\001\001' + os.linesep )
+		else:
+			self.file.write( os.linesep )
+
+	def write( self, text ):
+		if os.linesep != '\n':
+			text = text.replace( '\n', os.linesep )
+		self.file.write( text )
+
+	def copy( self, source ):
+		"""Copies a file over a chunk at a time, quoting 'From '
+		lines.  A newline too near the end of a chunk for us to see
+		whether a 'From ' follows it is held over to the next."""
+
+		held = ''
+		last = '\n'
+
+		while True:
+			chunk = source.read( spool_chunk )
+			text = held + chunk
+			held = ''
+
+			if chunk:
+				eol = text.rfind( '\n', max( 0, len( text ) - 5 ) )
+				if eol != -1:
+					held = text[eol:]
+					text = text[:eol]
+
+			if text:
+				self.write( quote_from( text, last == '\n' ) )
+				last = text[-1]
+
+			if not chunk:
+				break
+
+		if last != '\n' and not self.mmdf:
+			self.file.write( os.linesep )
+
+	def join( self, path ):
+		"""Copies the mailbox file at path, written by another
+		MboxWriter, onto the end of this one."""
+
+		source = open( path, 'rb' )
+		try:
+			shutil.copyfileobj( source, self.file, spool_chunk )
+		finally:
+			source.close()
+
+	def close( self ):
+		self.file.flush()
+		os.fsync( self.file.fileno() )
+		self.file.close()
+
+def quote_from( text, line_start = True ):
+	"""Quotes the lines of text beginning with 'From ', as the
+	mailbox module does, to keep them from being taken for the start
+	of a message.  line_start is false if text begins partway
+	through a line."""
+
+	if line_start and text.startswith( 'From ' ):
+		text = '>' + text
+	return text.replace( '\nFrom ', '\n>From ' )
+
 def create_mailbox( mailbox_name, format=None ):
 	"""Creates and returns a Python mailbox object that can be
 	used to write mail messages into.
@@ -348,11 +1070,11 @@ def create_mailbox( mailbox_name, format=None ):
 	
 	try:
 		if not format or format=='mbox':
-			newmailbox = mbox( mailbox_name )
+			newmailbox = MboxWriter( mailbox_name )
 		elif format=='maildir':
 			newmailbox = Maildir( mailbox_name )
 		elif format=='mmdf':
-			newmailbox = MMDF( mailbox_name )
+			newmailbox = MboxWriter( mailbox_name, True )
 		elif format=='mh':
 			newmailbox = MH( mailbox_name )
 		elif format=='babyl':
@@ -363,17 +1085,183 @@ def create_mailbox( mailbox_name, format=None ):
 
 	return newmailbox
 
-def extract_pieces( msg_lines, msg_offset, mbx, inner_mesg=False ):
-	"""Takes four parameters.  The first is a list of line strings
+def scrub_lines( text ):
+	"""Scrubs Eudora's markup out of text a line at a time, with the
+	three separate patterns.  scrub_body() falls back on this where
+	one markup tag turns up inside another, or where scrubbing one
+	leaves another behind, as the combined scan can't be trusted to
+	come out the same in those cases."""
+
+	scrubbed = []
+
+	for line in cStringIO.StringIO( text ):
+		orig_line = line
+
+		line = re.sub(re_xflowed, '', line)
+		line = re.sub(re_xhtml, '', line)
+		line = re.sub(re_pete_stuff, '', line)
+
+		if orig_line == line:
+			scrubbed.append(line)
+		elif line != '':
+			scrubbed.append(strip_linesep(line) + "\n")
+
+	return ''.join( scrubbed )
+
+def drop_blank_line( body ):
+	"""Drops the last line of body, a list of pieces of text or a
+	SpooledBody, if that line is blank."""
+
+	if isinstance( body, SpooledBody ):
+		body.drop_blank_line()
+	elif body:
+		if body[-1] == '\n':
+			body.pop()
+		elif body[-1].endswith( '\n\n' ):
+			body[-1] = body[-1][:-1]
+
+def scrub_body( text, handle_attachments = False ):
+	"""Scrubs a block of body lines, normalized text ending with a
+	newline, in a single pass.  Eudora's x-flowed, x-html and
+	x-stuff-for-pete markup is taken out if scrub_xflowed is set,
+	'Embedded Content' lines are taken out, and so are 'Attachment
+	Converted' lines, along with the blank line Eudora puts before
+	each of them, if handle_attachments is true.
+
+	Returns a tuple (scrubbed, is_html, attachments, embeddeds,
+	drops) containing the scrubbed text, whether any line looked
+	like HTML, the 'Attachment Converted' lines, the names from the
+	'Embedded Content' lines, and the number of 'Attachment
+	Converted' lines that came before any text was kept from the
+	block.  Each of those should drop a blank line from the end of
+	whatever body came before the block, with drop_blank_line()."""
+
+	if handle_attachments:
+		scanner = re_body_scan_attachments
+		first_line = re_body_first_line_attachments.match( text )
+	else:
+		scanner = re_body_scan
+		first_line = re_body_first_line.match( text )
+
+	if first_line:
+		matches = itertools.chain( [ first_line ], scanner.finditer( text, first_line.end() ) )
+	else:
+		matches = scanner.finditer( text )
+
+	kept = []
+	attachments = []
+	embeddeds = []
+	drops = 0
+	is_html = False
+
+	# The text between two 'Attachment Converted' or 'Embedded
+	# Content' lines is a segment, built up from pieces as the
+	# markup in it is taken out.
+
+	segment_start = 0
+	pos = 0
+	pieces = []
+	scrubbed = False
+	nested = False
+
+	for m in itertools.chain( matches, [ None ] ):
+		if m is None:
+			kind = None
+		else:
+			kind = m.lastgroup
+
+		if kind == 'html':
+			is_html = True
+			continue
+
+		if kind == 'xhtml' or kind == 'markup':
+			if kind == 'xhtml':
+				is_html = True
+			elif '<' in m.group( 'markup' ):
+				# x-stuff-for-pete wrapped around another tag
+				nested = True
+
+			if scrub_xflowed:
+				pieces.append( text[pos:m.start()] )
+				pos = m.end()
+				scrubbed = True
+
+			continue
+
+		# End of a segment.
+
+		if m is None:
+			segment_end = len( text )
+		else:
+			segment_end = m.start( kind )
+
+		pieces.append( text[pos:segment_end] )
+		segment = ''.join( pieces )
+
+		if nested:
+			raw = text[segment_start:segment_end]
+			if re_xhtml.search( raw ) or re_normal_html.search( raw ):
+				is_html = True
+
+		if scrubbed:
+			if nested or re_body_markup.search( segment ):
+				segment = scrub_lines( text[segment_start:segment_end] )
+			elif '\r\n' in segment:
+				segment = normalize_linesep( segment )
+
+		if segment:
+			kept.append( segment )
+
+		if m is None:
+			break
+
+		# the match stops short of the newline, so that the scan
+		# can find a line of the same kind right after this one
+
+		line_end = m.end( kind ) + 1
+		line = text[m.start( kind ):line_end]
+
+		if re_xhtml.search( line ) or re_normal_html.search( line ):
+			is_html = True
+
+		if kind == 'attachment':
+			# remove the newline that
+			# Eudora inserts before the
+			# 'Attachment Converted' line.
+
+			if kept:
+				drop_blank_line( kept )
+			else:
+				drops = drops + 1
+
+			attachments.append( line )
+		else:
+			embeddeds.append( m.group( 'filename' ) )
+
+		segment_start = pos = line_end
+		pieces = []
+		scrubbed = False
+		nested = False
+
+	return ( ''.join( kept ), is_html, attachments, embeddeds, drops )
+
+def extract_pieces( msg_chunks, msg_offset, mbx, inner_mesg=False, spool=False, raw=None ):
+	"""Takes five parameters.  The first is a list of strings
 	containing the headers and body of a message from a Eudora MBX
-	file.  The second is the offset of the first character in the
-	first line in the msg_lines list within the MBX file we're
+	file, with its line endings normalized, each ending with a
+	newline.  The second is the offset of the first character in
+	the message within the MBX file we're
 	processing.  The third is the name of the MBX file we're
 	reading.  The fourth, inner_mesg, is a boolean controlling
 	whether or not the pieces were are extracting are a top-level
 	message in the MBX file.  If inner_mesg is true, we will carry
 	out our processing under the assumption that we are handling
 	an attached message carried in an message/rfc822 segment.
+	The fifth, spool, is true for messages too long to handle in
+	memory; msg_chunks may then be any iterable of strings, and the
+	body is collected in a SpooledBody.  The sixth, raw, is a
+	RawHeaders object to record the header lines in as they were,
+	for passthrough_message().
 	
 	Returns a tuple (header, body, attachments, embeddeds, mbx)
 	containing a Header object, a body String containing the body
@@ -385,7 +1273,10 @@ def extract_pieces( msg_lines, msg_offset, mbx, inner_mesg=False ):
 	global target
 
 	headers = Header()
-	body = []
+	if spool:
+		body = SpooledBody()
+	else:
+		body = []
 	attachments = []
 	embeddeds = []
 
@@ -393,84 +1284,226 @@ def extract_pieces( msg_lines, msg_offset, mbx, inner_mesg=False ):
 	found_rfc822_inner_mesg = False
 	is_html = False
 
-	if not inner_mesg:
-		headers.add( 'From ', msg_lines[0][5:].strip() )
+	# The message comes as normalized text (see normalize_linesep()),
+	# in one or more chunks that each end with a newline.  Header
+	# lines are sliced out of it one at a time; the rest is the body.
 
-	for line in msg_lines:
-		if in_headers:
-			if re_initial_whitespace.match( line ):
-				# Header "folding" (RFC 2822 3.2.3)
-				headers.appendToLast( line )
-			elif len( line.strip() ) != 0:
-				# Message header
-				headers.add_line(line)
+	msg_chunks = iter( msg_chunks )
+	text = ''
+	pos = 0
+	first_line = not inner_mesg
 
-				attachment_matcher = re_x_attachment.match( line )
+	while in_headers:
+		eol = text.find( '\n', pos )
 
-				if attachment_matcher:
-					files = attachment_matcher.group(1)
-					attach_list = re.split(';\s*', files)
+		if eol == -1:
+			try:
+				text = msg_chunks.next()
+			except StopIteration:
+				text = ''
+				break
+			pos = 0
+			continue
 
-					for attachment in attach_list:
-						attachments.append( (attachment, target) )
-			else:
-				# End of message headers.
+		line = text[pos:eol + 1]
+		pos = eol + 1
+
+		if first_line:
+			headers.add( 'From ', line[5:].strip() )
+			first_line = False
 
-				# scrub the header lines we've scanned
+			if raw:
+				raw.from_line = line
 
-				if not inner_mesg:
-					headers.clean(toc_info, msg_offset, replies)
+		if re_initial_whitespace.match( line ):
+			# Header "folding" (RFC 2822 3.2.3)
+			headers.appendToLast( line )
 
-				in_headers = False
+			if raw:
+				raw.extend( line )
+		elif len( line.strip() ) != 0:
+			# Message header
+			count = len( headers.data )
+			headers.add_line(line)
 
-				content_type = headers.getValue('Content-Type:')
+			if raw and raw.from_line is not line:
+				raw.add( headers, count, line )
 
-				if content_type and content_type.lower() == 'message/rfc822':
-					found_rfc822_inner_mesg = True
-					print "+",
-		elif found_rfc822_inner_mesg:
+			attachment_matcher = re_x_attachment.match( line )
+
+			if attachment_matcher:
+				files = attachment_matcher.group(1)
+				attach_list = re.split(';\s*', files)
+
+				for attachment in attach_list:
+					attachments.append( (attachment, target) )
+		else:
+			# End of message headers.
+
+			# scrub the header lines we've scanned
+
+			if raw:
+				raw.close( line )
+
+			if not inner_mesg:
+				headers.clean(toc_info, msg_offset, replies)
+
+			in_headers = False
+
+			content_type = headers.getValue('Content-Type:')
+
+			if content_type and content_type.lower() == 'message/rfc822':
+				found_rfc822_inner_mesg = True
+				print "+",
+
+	for chunk in itertools.chain( [ text[pos:] ], msg_chunks ):
+		if not chunk:
+			continue
+
+		if found_rfc822_inner_mesg:
 			# We're processing a message/rfc822 message,
 			# and so we don't want to process attachments
 			# at this level.  Instead, we want to properly
 			# extract all body lines for later processing
 
-			body.append(strip_linesep(line) + "\n")
-		else:
-			# We're in the body of the text and we need to
-			# handle attachments
+			body.append(chunk)
+			continue
 
-			if not is_html and re_xhtml.search( line ) or re_normal_html.search( line ):
-				is_html = True
+		# We're in the body of the text and we need to
+		# handle attachments
 
-			if attachments_dirs and re_attachment.search( line ):
-				# remove the newline that
-				# Eudora inserts before the
-				# 'Attachment Converted' line.
+		( scrubbed, chunk_is_html, chunk_attachments, chunk_embeddeds, drops ) = \
+			scrub_body( chunk, attachments_dirs )
 
-				if len(body) > 0 and (body[-1] == '\n' or body[-1] == '\r\n'):
-					body.pop()
+		if chunk_is_html:
+			is_html = True
 
-				#EudoraLog.log.warn("Adding attachment with contenttype = " + contenttype)
-				attachments.append( (line, target) )
-			else:
-				embedded_matcher = re_embedded.match ( line )
-					
-				if embedded_matcher:
-					filename = embedded_matcher.group(1)
-					embeddeds.append( filename )
-				else:
-					orig_line = line
+		for i in range( drops ):
+			drop_blank_line( body )
+
+		if scrubbed:
+			body.append( scrubbed )
 
-					if scrub_xflowed:
-						line = re.sub(re_xflowed, '', line)
-						line = re.sub(re_xhtml, '', line)
-						line = re.sub(re_pete_stuff, '', line)
+		for line in chunk_attachments:
+			#EudoraLog.log.warn("Adding attachment with contenttype = " + contenttype)
+			attachments.append( (line, target) )
 
-					if orig_line == line or line != '':
-						body.append(strip_linesep(line) + "\n")
+		embeddeds.extend( chunk_embeddeds )
 
 	return ( headers, body, attachments, embeddeds, mbx, is_html )
 
+class RawHeaders:
+	"""The header lines of a message as they were in the mailbox, each
+	next to the Field it was parsed into, and its value before
+	Header.clean() got to it.  intact is cleared if any line didn't
+	come through add_line() as a header of its own."""
+
+	def __init__( self ):
+		self.from_line = None
+		self.lines = []
+		self.values = None
+		self.blank_line = None
+		self.intact = True
+
+	def add( self, headers, count, line ):
+		if len( headers.data ) == count + 1 and not headers.data[-1].id.startswith( '>' ):
+			self.lines.append( ( headers.data[-1], line ) )
+		else:
+			self.intact = False
+
+	def extend( self, line ):
+		if self.lines:
+			( field, text ) = self.lines[-1]
+			self.lines[-1] = ( field, text + line )
+		else:
+			self.intact = False
+
+	def close( self, line ):
+		self.blank_line = line
+		self.values = {}
+		for ( field, text ) in self.lines:
+			self.values[field] = field.value
+
+	def length( self ):
+		return len( self.from_line ) + len( self.blank_line ) \
+			+ sum( [ len( text ) for ( field, text ) in self.lines ] )
+
+# Header.clean() may change or add these without the message needing
+# to be rebuilt; see passthrough_message().
+
+passthrough_ids = ( 'status:', 'x-status:', 'x-priority:', 'x-eudora2unix:' )
+
+def passthrough_message( raw, text, headers, body, attachments, embeddeds, is_html ):
+	"""Many messages need no rewriting: they have a From: and a
+	Date:, no attachments or embedded content, nothing for
+	scrub_body() to take out, and a simple Content-Type, or none and
+	no HTML.  Building such a message up as an email.message object
+	only for the mailbox to flatten it again is wasted effort.
+
+	Given the RawHeaders and the normalized text of a message, and
+	the pieces extract_pieces() made of it, returns the message as a
+	list of pieces of text for MboxWriter.add() if it is one of
+	these, or None if it needs craft_message().  The first piece is
+	the fixed 'From ' line; the rest are the message as it was, but
+	for the Status:, X-Status:, X-Priority: and X-Eudora2Unix:
+	headers Header.clean() changed or added."""
+
+	if not raw.intact or raw.values is None or attachments or embeddeds \
+		or not headers.getValue( 'From ' ):
+		return None
+
+	date = headers.first.get( 'date:' )
+	from_field = headers.first.get( 'from:' )
+
+	if not date or not from_field or not raw.values.has_key( date ) \
+		or not raw.values.has_key( from_field ) or not date.value or not from_field.value:
+		return None
+
+	contenttype = headers.getValue( 'Content-Type:' )
+
+	if contenttype:
+		mimetype = re_single_contenttype.search( contenttype )
+
+		if not mimetype or mimetype.group(1).lower() == 'multipart' \
+			or re_rfc822.search( contenttype ):
+			return None
+	elif is_html or headers.getValue( 'X-MS-Attachment:' ):
+		return None
+
+	start = raw.length()
+	body_text = ''.join( body )
+
+	if len( body_text ) != len( text ) - start:
+		# scrub_body() took something out
+		return None
+
+	lines = [ 'From ' + headers.getValue( 'From ' ) + '\n' ]
+
+	for field in headers.data:
+		if raw.values.has_key( field ):
+			if field.value == raw.values[field]:
+				continue
+		elif field.lcid == 'from ':
+			continue
+
+		if field.lcid not in passthrough_ids:
+			return None
+
+	for ( field, line ) in raw.lines:
+		if field.value == raw.values[field]:
+			lines.append( line )
+		else:
+			lines.append( field.id + ' ' + field.value + '\n' )
+
+	for field in headers.data:
+		if not raw.values.has_key( field ) and field.lcid != 'from ':
+			lines.append( field.id + ' ' + field.value + '\n' )
+
+	lines.append( raw.blank_line )
+	lines.append( body_text )
+
+	return lines
+
 def craft_message( headers, body, attachments, embeddeds, mbx, is_html):
 	"""This function handles the creation of a Python
 	email.message object from the headers and body lists created
@@ -481,7 +1514,9 @@ def craft_message( headers, body, attachments, embeddeds, mbx, is_html):
 	attachments_ok = False
 	embeddedcids = []
 
-	if body:
+	if isinstance( body, SpooledBody ):
+		msg_text = body.token
+	elif body:
 		msg_text = ''.join(body)
 	else:
 		msg_text = ''
@@ -520,7 +1555,7 @@ def craft_message( headers, body, attachments, embeddeds, mbx, is_html):
 			print "T",
 	elif re_rfc822.search( contenttype ):
 		print "[",
-		message = MIMEMessage(craft_message(*extract_pieces(body, -1, mbx, True)))
+		message = MIMEMessage(craft_message(*extract_pieces(body, -1, mbx, True, isinstance(body, SpooledBody))))
 		print "]",
 	elif not is_multipart:
 		mimetype = re_single_contenttype.search( contenttype )
@@ -580,19 +1615,30 @@ def craft_message( headers, body, attachments, embeddeds, mbx, is_html):
 			print "Found embeddeds in multipart!\n"
 
 
-		p = EudoraHTMLParser()
+		if isinstance( body, SpooledBody ):
+			html_lines = body
+			cids = None
+		else:
+			html_lines = [ msg_text ]
+			cids = scan_cids( msg_text )
+
+		# scan_cids() leaves anything it isn't sure of to the parser
 
 		try:
-			p.feed(msg_text)
-			cids = p.get_cids()
+			if cids is None:
+				p = EudoraHTMLParser()
+				for html in html_lines:
+					p.feed(html)
+				cids = p.get_cids()
 		except HTMLParseError:
 			# okay, we've got unparseable HTML here.
 			# Let's just use a quick regexp to see if we can make sense of this.
 
 			cids = []
 
-			for match in re_cids_finder.finditer(msg_text):
-				cids.append("cid:" + match.group(1))
+			for html in html_lines:
+				for match in re_cids_finder.finditer(html):
+					cids.append("cid:" + match.group(1))
 
 		if not len(cids) == len(embeddeds):
 			print "cids / embeddeds mismatch!"
@@ -620,7 +1666,7 @@ def craft_message( headers, body, attachments, embeddeds, mbx, is_html):
 			if i < len(embeddeds):
 				print embeddeds[i],
 
-				if edir and os.path.exists(edir + os.sep + embeddeds[i]):
+				if embedded_file(embeddeds[i]):
 					print " *"
 				else:
 					print " !"
@@ -687,10 +1733,19 @@ def craft_message( headers, body, attachments, embeddeds, mbx, is_html):
 		if not isinstance( message, MIMEMessage ):
 			if not isinstance( message, MIMEMultipart):
 				message.set_payload(msg_text)
-			elif is_html:
-				message.attach(MIMEText(msg_text, _subtype='html'))
 			else:
-				message.attach(MIMEText(msg_text))
+				if is_html:
+					text = MIMEText(msg_text, _subtype='html')
+				else:
+					text = MIMEText(msg_text)
+
+				# MIMEText picked the transfer encoding by
+				# looking at the token, not the body
+
+				if isinstance( body, SpooledBody ) and body.eight_bit:
+					text.replace_header('Content-Transfer-Encoding', '8bit')
+
+				message.attach(text)
 	except Exception, e:
 		print "\nHEY HEY HEY message = " + str(msg_text) + "\n"
 		print "Type of message's payload is " + str(type(message.get_payload())) + "\n"
@@ -732,33 +1787,404 @@ def set_headers( message, headers):
 	if myfrom:
 		message.set_unixfrom('From ' + myfrom)
 
-def handle_attachment( line, target, message ):
+def attachment_listing( dir ):
+	"""The set of names in dir, or None if it can't be listed."""
+	try:
+		return attachment_listings[dir]
+	except KeyError:
+		try:
+			names = set( os.listdir( dir or os.curdir ) )
+		except OSError:
+			names = None	# not a directory we can list
+		attachment_listings[dir] = names
+		return names
+
+def attachment_exists( path ):
+	"""os.path.exists(), for a file in an attachment directory."""
+	( dir, name ) = os.path.split( path )
+	names = attachment_listing( dir )
+	if names is None or name in ( '', os.curdir, os.pardir ):
+		return os.path.exists( path )
+	return name in names
+
+def embedded_index( dir ):
+	"""name: ( stat, mimeinfo ) for each file in dir; see embedded_indexes."""
+	try:
+		return embedded_indexes[dir]
+	except KeyError:
+		pass
+	index = {}
+	try:
+		names = os.listdir( dir )
+	except OSError:
+		names = []
+	for name in names:
+		try:
+			st = os.stat( os.path.join( dir, name ) )
+		except OSError:
+			continue
+		index[name] = ( st, mimetypes.guess_type( name ) )
+	embedded_indexes[dir] = index
+	return index
+
+def embedded_file( filename ):
 	"""
-	Mac versions put "Attachment converted", Windows (Lite) has
-	"Attachment Converted". 
+	The ( stat, mimeinfo ) of the embedded file named filename in edir,
+	or None if there's no such file.
+	"""
+	if not edir:
+		return None
+	if os.sep in filename or filename in ( '', os.curdir, os.pardir ):
+		path = edir + os.sep + filename
+		try:
+			return ( os.stat( path ), mimetypes.guess_type( path ) )
+		except OSError:
+			return None
+	return embedded_index( edir ).get( filename )
+
+class PrefetchedFile:
+	"""A file a Prefetcher has been asked for: its stat() and, if it
+	was read, its contents.  finished is set once it's been fetched."""
+
+	def __init__( self, batch ):
+		self.batch = batch
+		self.stat = None
+		self.data = None
+		self.size = 0		# bytes held against the Prefetcher's limit
+		self.finished = False
+		self.dropped = False
+		self.done = threading.Event()
+
+class Prefetcher:
+	"""Threads that find and read ahead the files the messages to come
+	refer to; see prefetch_threads.
+
+	convert() submit()s each message prefetch_ahead messages before it
+	converts it, and release()s whatever of its files went unused
+	once it has; attachment_part() take()s each file it encodes.  A
+	file is read only while the data held stays within the limit;
+	otherwise, or if it's too big to be kept in memory anyway (see
+	stream_threshold), only its stat() is prefetched."""
+
+	def __init__( self, threads, limit ):
+		self.limit = limit
+		self.size = 0
+		self.lock = threading.Lock()
+		self.files = {}		# path: PrefetchedFile
+		self.batches = {}	# message offset: the paths fetched for it
+		self.jobs = Queue.Queue()
+		self.threads = []
+		for i in range( threads ):
+			thread = threading.Thread( target = self.work )
+			thread.daemon = True
+			thread.start()
+			self.threads.append( thread )
+
+	def submit( self, mailbox, span ):
+		"""Queues the files the message at span refers to."""
+		( offset, length ) = span
+		if length > spool_threshold:
+			return
+		refs = [ m.groups() for m in
+			re_prefetch_refs.finditer( mailbox, offset, offset + length ) ]
+		if refs:
+			self.jobs.put( ( offset, refs ) )
+
+	def work( self ):
+		while True:
+			job = self.jobs.get()
+			if job is None:
+				return
+			( batch, refs ) = job
+			for ( attachment, x_attachments, embedded ) in refs:
+				# anything that goes wrong here goes wrong again,
+				# and is reported, when the message is converted
+				try:
+					if attachment:
+						lines = [ attachment ]
+					elif x_attachments:
+						lines = re.split( ';\s*', x_attachments )
+					else:
+						if edir:
+							self.fetch( batch, edir + os.sep + embedded )
+						continue
+					for line in lines:
+						located = attachment_file( line, target )
+						if located:
+							self.fetch( batch, located[3] )
+				except Exception:
+					pass
+
+	def fetch( self, batch, path ):
+		with self.lock:
+			if path in self.files:
+				return
+			fetched = self.files[path] = PrefetchedFile( batch )
+			self.batches.setdefault( batch, [] ).append( path )
 
-	Next comes a system-dependent path to the attachment binary.
-	On mac version, separated by colons, starts with volume, but omits
-	path elements between:
+		st = data = None
+		try:
+			st = os.stat( path )
+			with self.lock:
+				if ( stat.S_ISREG( st.st_mode ) and st.st_size <= stream_threshold
+						and self.size + st.st_size <= self.limit
+						and not fetched.dropped ):
+					fetched.size = st.st_size
+					self.size += fetched.size
+			if fetched.size:
+				fp = open( path, 'rb' )
+				try:
+					data = fp.read()
+				finally:
+					fp.close()
+		except EnvironmentError:
+			pass
+
+		with self.lock:
+			fetched.stat = st
+			if fetched.dropped or data is None or len( data ) != fetched.size:
+				self.size -= fetched.size
+				fetched.size = 0
+			else:
+				fetched.data = data
+			fetched.finished = True
+		fetched.done.set()
+
+	def take( self, path ):
+		"""
+		The ( stat, data ) of the file at path, data being None if it
+		wasn't read, or None if it wasn't prefetched (or couldn't be).
+		"""
+		with self.lock:
+			fetched = self.files.pop( path, None )
+		if not fetched:
+			return None
+		fetched.done.wait()
+		with self.lock:
+			self.size -= fetched.size
+			fetched.size = 0
+		if not fetched.stat:
+			return None
+		return ( fetched.stat, fetched.data )
+
+	def release( self, batch ):
+		"""Drops the files fetched for the message at batch."""
+		with self.lock:
+			for path in self.batches.pop( batch, () ):
+				fetched = self.files.get( path )
+				if not fetched or fetched.batch != batch:
+					continue
+				del self.files[path]
+				if fetched.finished:
+					self.size -= fetched.size
+					fetched.size = 0
+				else:
+					fetched.dropped = True
 
-	Eudora Folder:Attachments Folder. 
+	def close( self ):
+		for thread in self.threads:
+			self.jobs.put( None )
+		for thread in self.threads:
+			thread.join()
 
-	Windows versions have a full DOS path name to the binary
-	(Lite version uses 8-char filenames)
-	
-	This replaces that filepath with a file URI to the file in the
-	attachments_dirs directories.  This has no direct effect in Kmail, but 
-	sometimes Pine can open the file (so long as there aren't any 
-	spaces in the filepath).  At least it makes more sense than
-	leaving the old filepath.
+def attachment_part( path, mimetype, mimesubtype, st = None ):
 	"""
+	A MIME part holding the file at path, encoded as mimetype requires,
+	or None if it's a type we don't know how to encode.  st is the
+	file's stat(), if it's known already.  See part_cache,
+	stream_threshold and prefetch_threads, and attachment_store for the
+	part that stands in for it with -x.
+	"""
+	global part_cache_size
+
+	part_class = part_classes.get( mimetype )
+	if not part_class and not attachment_store:
+		return None
+	fetched = prefetcher and prefetcher.take( path )
+	if fetched:
+		( st, data ) = fetched
+	else:
+		( st, data ) = ( st or os.stat( path ), None )
+	if attachment_store:
+		conversion.part_cache_misses += 1
+		return external_part( stored_file( path, st, data ), st,
+			mimetype, mimesubtype )
+	if st.st_size > stream_threshold and mimetype != 'text':
+		conversion.part_cache_misses += 1
+		return StreamedAttachment( path ).part( mimetype, mimesubtype )
+	key = ( os.path.abspath( path ), st.st_size, st.st_mtime,
+		mimetype, mimesubtype )
+	if key in part_cache:
+		part = part_cache.pop( key )
+		part_cache[key] = part		# now the most recently used
+		conversion.part_cache_hits += 1
+		return copy.deepcopy( part )
+	conversion.part_cache_misses += 1
+
+	if data is None:
+		fp = open( path, 'rb' )
+		try:
+			data = fp.read()
+		finally:
+			fp.close()
+	part = part_class( data, _subtype=mimesubtype )
+
+	size = len( part.get_payload() )
+	if size <= part_cache_limit:
+		part_cache[key] = copy.deepcopy( part )
+		part_cache_size += size
+		while part_cache_size > part_cache_limit:
+			( old_key, old_part ) = part_cache.popitem( last=False )
+			part_cache_size -= len( old_part.get_payload() )
+	return part
+
+def stored_file( path, st, data = None ):
+	"""
+	The path of the copy of the file at path in attachment_store,
+	putting one there if there isn't one yet.  st is the file's stat(),
+	and data its contents, if they've been read already.
+	"""
+	key = ( os.path.abspath( path ), st.st_size, st.st_mtime )
+	digest = store_digests.get( key )
+	if not digest:
+		sha = hashlib.sha1()
+		if data is not None:
+			sha.update( data )
+		else:
+			fp = open( path, 'rb' )
+			try:
+				for chunk in iter( lambda: fp.read( spool_chunk ), '' ):
+					sha.update( chunk )
+			finally:
+				fp.close()
+		digest = store_digests[key] = sha.hexdigest()
+
+	stored = os.path.join( attachment_store, digest[:2], digest )
+	if os.path.exists( stored ):
+		conversion.store_reused += 1
+		return stored
+	dir = os.path.dirname( stored )
+	if not os.path.isdir( dir ):
+		try:
+			os.makedirs( dir )
+		except OSError, e:
+			if e.errno != errno.EEXIST:
+				raise
+	try:
+		os.link( path, stored )
+	except ( OSError, AttributeError ), e:
+		if getattr( e, 'errno', None ) == errno.EEXIST:
+			conversion.store_reused += 1
+			return stored
+		# another file system, or one without hard links
+		temp = '%s.%d.tmp' % ( stored, os.getpid() )
+		shutil.copyfile( path, temp )
+		os.rename( temp, stored )
+	conversion.store_added += 1
+	return stored
+
+def external_part( stored, st, mimetype, mimesubtype ):
+	"""A message/external-body part referring to the stored file."""
+	part = MIMENonMultipart( 'message', 'external-body' )
+	part.set_param( 'access-type', 'local-file' )
+	part.set_param( 'name', stored )
+	part.set_param( 'size', str( st.st_size ) )
+	part.set_payload( 'Content-Type: %s/%s\nContent-Transfer-Encoding: binary\n\n'
+		% ( mimetype, mimesubtype ) )
+	return part
+
+def mac_name_index( dirs ):
+	"""The index of the files in dirs; see mac_name_indexes."""
+	try:
+		return mac_name_indexes[dirs]
+	except KeyError:
+		pass
+	index = {}
+	for dir in dirs:
+		for name in attachment_listing( dir ) or ():
+			ext = os.path.splitext( name )[1][1:].lower()
+			if ext:
+				index.setdefault( ext, [] ).append(
+					( name.lower(), os.path.join( dir, name ) ) )
+	for names in index.itervalues():
+		names.sort()
+	mac_name_indexes[dirs] = index
+	return index
+
+def has_words_in_order( words, name ):
+	pos = 0
+	for word in words:
+		pos = name.find( word, pos )
+		if pos < 0:
+			return False
+		pos += len( word )
+	return True
+
+def mac_name_candidates( name, dirs ):
+	"""
+	Returns the files in the directories dirs that the shortened Mac
+	name might stand for, likeliest first, and whether the first is
+	the only one that fits.
+
+	A file fits if its name has the extension of the shortened one,
+	begins with the first word of it, and holds all its words in order,
+	the last of which may have been cut short.  Those beginning with
+	more of the shortened name come first.  If none fit, the files
+	sharing the longest beginning with it are returned, for the log.
+	"""
+	m = re_mangled_mac_parts.match( name )
+	if not m:
+		return ( [], False )
+	( stem, ext ) = m.groups()
+	names = mac_name_index( dirs ).get( ext.lower() )
+	words = re.findall( r'[^\W_]+', stem.lower() )
+	if not names or not words:
+		return ( [], False )
+	key = stem.lower()
+	shortest = key.find( words[0] ) + len( words[0] )
+
+	# Shorten the stem until some files begin with it, and then until
+	# some of those fit, or there are too many of them to go through.
+	fits = []
+	near = []
+	lo = hi = 0
+	for length in xrange( len( key ), shortest - 1, -1 ):
+		prefix = key[:length]
+		( new_lo, new_hi ) = ( bisect.bisect_left( names, ( prefix, ) ),
+			bisect.bisect_left( names, ( prefix + '\xff', ) ) )
+		if new_lo == new_hi or ( new_lo, new_hi ) == ( lo, hi ):
+			continue
+		if new_hi - new_lo > mac_name_range_limit:
+			break
+		( lo, hi ) = ( new_lo, new_hi )
+		if not near:
+			near = [ path for ( lower, path ) in names[lo:hi] ][:5]
+		fits = [ ( lower, path ) for ( lower, path ) in names[lo:hi]
+			if lower.endswith( '.' + ext.lower() )
+				and has_words_in_order( words, lower ) ]
+		if fits:
+			break
+	if not fits:
+		return ( near, False )
+
+	def shared( lower ):
+		n = 0
+		while n < len( key ) and n < len( lower ) and key[n] == lower[n]:
+			n += 1
+		return n
+	fits.sort( key = lambda ( lower, path ): ( -shared( lower ), len( lower ) ) )
+	return ( [ path for ( lower, path ) in fits ], len( fits ) == 1 )
+
+def attachment_file( line, target ):
+	"""
+	Works out which file in the attachments_dirs directories the
+	attachment line refers to; see handle_attachment().  Returns
+	( attachment_desc, orig_path, name, filename, mimeinfo, candidates ),
+	or None if the line names no file.  candidates are the files a
+	name Mac Eudora shortened might stand for, if it fits more than one.
 
-	global attachments_listed, attachments_found, attachments_missing, attachments_dirs
-	global paths_found, paths_missing
-	global missing_attachments, found_attachments
-	global mac_mismatches
-
-	attachments_listed = attachments_listed + 1
+	It changes nothing, so that the Prefetcher can call it too.
+	"""
 
 	# Mac 1.3.1 has e.g. (Type: 'PDF ' Creator: 'CARO')
 	# Mac 3.1 has e.g (PDF /CARO) (00000645)
@@ -775,9 +2201,6 @@ def handle_attachment( line, target, message ):
 
 		attachment_desc = line
 
-	if attachment_desc.find('"') != -1:
-		print "**>>**", attachment_desc
-
 	attachment_desc = strip_linesep(attachment_desc)
 
 	# some of John's attachment names have an odd OutboundG4:
@@ -808,17 +2231,18 @@ def handle_attachment( line, target, message ):
 		orig_path = attachment_desc
 
 	if len( name ) <= 0:
-		return
+		return None
 
 	filename = None
+	given_name = name
 
 	for adir in attachments_dirs:
-		if not filename or not os.path.exists(filename):
+		if not filename or not attachment_exists(filename):
 			filename = os.path.join( target, adir, name )
 			if not os.path.isabs( target ):
 				filename = os.path.join( os.environ['HOME'], filename )
 
-			if not os.path.exists(filename):
+			if not attachment_exists(filename):
 				if name.startswith('OutboundG4:'):
 					name = name[11:]
 					print "**** Hey, name is now %s" % (name, )
@@ -828,7 +2252,7 @@ def handle_attachment( line, target, message ):
 			# the file name, but when they got copied over to
 			# unix, the / chars were taken out, if it would help.
 
-			if not os.path.exists(filename):
+			if not attachment_exists(filename):
 				if name.find('/') != -1:
 					name=name.replace('/','')
 					filename = os.path.join(target, adir, name)
@@ -837,7 +2261,7 @@ def handle_attachment( line, target, message ):
 			# in the file name where the file on disk has spaces.
 			# translate that as well, if it would help.
 
-			if not os.path.exists(filename):
+			if not attachment_exists(filename):
 				if name.find('_') != -1:
 					name = name.replace('_', ' ')
 					filename = os.path.join(target, adir, name)
@@ -847,7 +2271,7 @@ def handle_attachment( line, target, message ):
 			# disk has underscores.  if we didn't find the match
 			# after our last transform, try the rever
 
-			if not os.path.exists(filename):
+			if not attachment_exists(filename):
 				if name.find(' ') != -1:
 					name = name.replace(' ', '_')
 					filename = os.path.join(target, adir, name)
@@ -864,53 +2288,97 @@ def handle_attachment( line, target, message ):
 
 	mimeinfo = mimetypes.guess_type(filename)
 
-	if not os.path.exists(filename):
+	if not attachment_exists(filename):
 		cleaner_match = re_filename_cleaner.match(filename.replace('_', ' '))
 
-		if cleaner_match and os.path.exists(cleaner_match.group(1)):
+		if cleaner_match and attachment_exists(cleaner_match.group(1)):
 			filename = cleaner_match.group(1)
 
+	# a name Mac Eudora shortened is attached if it fits only one file
+
+	candidates = []
+	if not attachment_exists(filename) and re_mangled_mac.search(filename):
+		dirs = []
+		for adir in attachments_dirs:
+			dir = os.path.join( target, adir )
+			if not os.path.isabs( target ):
+				dir = os.path.join( os.environ['HOME'], dir )
+			dirs.append( dir )
+		( candidates, only ) = mac_name_candidates( given_name, tuple( dirs ) )
+		if only:
+			filename = candidates[0]
+			name = os.path.basename( filename )
+			mimeinfo = mimetypes.guess_type(filename)
+			candidates = []
+
+	return ( attachment_desc, orig_path, name, filename, mimeinfo, candidates )
+
+def handle_attachment( line, target, message ):
+	"""
+	Mac versions put "Attachment converted", Windows (Lite) has
+	"Attachment Converted". 
+
+	Next comes a system-dependent path to the attachment binary.
+	On mac version, separated by colons, starts with volume, but omits
+	path elements between:
+
+	Eudora Folder:Attachments Folder. 
+
+	Windows versions have a full DOS path name to the binary
+	(Lite version uses 8-char filenames)
+	
+	This replaces that filepath with a file URI to the file in the
+	attachments_dirs directories.  This has no direct effect in Kmail, but 
+	sometimes Pine can open the file (so long as there aren't any 
+	spaces in the filepath).  At least it makes more sense than
+	leaving the old filepath.
+	"""
+
+	conversion.attachments_listed = conversion.attachments_listed + 1
+
+	located = attachment_file( line, target )
+	if not located:
+		return
+	( attachment_desc, orig_path, name, filename, mimeinfo, candidates ) = located
+
+	if attachment_desc.find('"') != -1:
+		print "**>>**", attachment_desc
+
+	if candidates:
+		conversion.mac_candidates[filename] = candidates
+
 	if not mimeinfo[0]:
 		(mimetype, mimesubtype) = ('application', 'octet-stream')
 	else:
 		(mimetype, mimesubtype) = mimeinfo[0].split('/')
 
 	if os.path.isfile(filename):
-		fp = open(filename, 'rb')
-
-		try:
-			if mimetype == 'application' or mimetype == 'video':
-				msg = MIMEApplication(fp.read(), _subtype=mimesubtype)
-			elif mimetype == 'image':
-				msg = MIMEImage(fp.read(), _subtype=mimesubtype)
-			elif mimetype == 'text':
-				msg = MIMEText(fp.read(), _subtype=mimesubtype)
-			elif mimetype == 'audio':
-				msg = MIMEAudio(fp.read(), _subtype=mimesubtype)
-			else:
-				EudoraLog.log.error("Unrecognized mime type '%s' while processing attachment '%s'" % (mimeinfo[0], filename))
-				return
-		finally:
-			fp.close()
+		msg = attachment_part(filename, mimetype, mimesubtype)
+		if not msg:
+			EudoraLog.log.error("Unrecognized mime type '%s' while processing attachment '%s'" % (mimeinfo[0], filename))
+			return
 
 		msg.add_header('Content-Disposition', 'attachment', filename=name)
 
 		message.attach(msg)
 
-		attachments_found = attachments_found + 1
+		conversion.attachments_found = conversion.attachments_found + 1
 
 #		EudoraLog.log.warn(" SUCCEEDED finding attachment: \'" + attachment_desc + "\', name = \'" + name + "\'")
+		paths_found = conversion.paths_found
 		if orig_path in paths_found:
 			paths_found[orig_path] = paths_found[orig_path] + 1
 		else:
 			paths_found[orig_path] = 1
 
+		found_attachments = conversion.found_attachments
 		if not EudoraLog.log.mbx_name() in found_attachments:
 			found_attachments[EudoraLog.log.mbx_name()] = []
 		found_attachments[EudoraLog.log.mbx_name()].append((attachment_desc, filename))
 	else:
-		attachments_missing = attachments_missing + 1
+		conversion.attachments_missing = conversion.attachments_missing + 1
 
+		missing_attachments = conversion.missing_attachments
 		if not EudoraLog.log.mbx_name() in missing_attachments:
 			missing_attachments[EudoraLog.log.mbx_name()] = []
 		missing_attachments[EudoraLog.log.mbx_name()].append(attachment_desc)
@@ -919,8 +2387,9 @@ def handle_attachment( line, target, message ):
 
 		if re_mangled_mac.search(filename):
 			print "Mac pattern: %s" % (filename, )
-			mac_mismatches.append(filename)
+			conversion.mac_mismatches.append(filename)
 
+		paths_missing = conversion.paths_missing
 		if orig_path in paths_missing:
 			paths_missing[orig_path] = paths_missing[orig_path] + 1
 		else:
@@ -928,43 +2397,29 @@ def handle_attachment( line, target, message ):
 
 def handle_embedded( cid, filename, message ):
 	global edir
-	global attachments_listed, attachments_found, attachments_missing, attachments_dirs
-	global paths_found, paths_missing
-	global missing_attachments, found_attachments
 
 	if edir:
 		realfilename = edir + os.sep + filename
+		found = embedded_file(filename)
 
-		if not os.path.exists(realfilename):
+		if not found:
 			print "Couldn't find embedded file %s" % (realfilename,)
 			return
 	else:
 		return
 
-	mimeinfo = mimetypes.guess_type(realfilename)
+	(st, mimeinfo) = found
 
 	if not mimeinfo[0]:
 		(mimetype, mimesubtype) = ('application', 'octet-stream')
 	else:
 		(mimetype, mimesubtype) = mimeinfo[0].split('/')
 
-	if os.path.isfile(realfilename):
-		fp = open(realfilename, 'rb')
-
-		try:
-			if mimetype == 'application' or mimetype == 'video':
-				msg = MIMEApplication(fp.read(), _subtype=mimesubtype)
-			elif mimetype == 'image':
-				msg = MIMEImage(fp.read(), _subtype=mimesubtype)
-			elif mimetype == 'text':
-				msg = MIMEText(fp.read(), _subtype=mimesubtype)
-			elif mimetype == 'audio':
-				msg = MIMEAudio(fp.read(), _subtype=mimesubtype)
-			else:
-				EudoraLog.log.error("Unrecognized mime type '%s' while processing attachment '%s'" % (mimeinfo[0], filename))
-				return
-		finally:
-			fp.close()
+	if stat.S_ISREG(st.st_mode):
+		msg = attachment_part(realfilename, mimetype, mimesubtype, st)
+		if not msg:
+			EudoraLog.log.error("Unrecognized mime type '%s' while processing attachment '%s'" % (mimeinfo[0], filename))
+			return
 
 		if cid:
 			msg.add_header('Content-ID', cid)
@@ -975,16 +2430,32 @@ def handle_embedded( cid, filename, message ):
 		message.attach(msg)
 
 
+def convert_worker( args ):
+	"""
+	convert() in a worker process, given ( mbx, embedded_dir, opts ).
+	Returns the Conversion of that mailbox alone, for the parent to
+	merge() into its own.  Called in the parent itself, it leaves the
+	parent's conversion as it was.
+	"""
+	global conversion
+
+	( parent, conversion ) = ( conversion, Conversion() )
+	try:
+		convert( *args )
+		return conversion
+	finally:
+		conversion = parent
+
 #import profile
 # File argument (must be exactly 1).
 if sys.argv[0].find( 'Eudora2Mbox.py' ) > -1:	# i.e. if script called directly
 	#profile.run( 'convert( sys.argv[1] )' )
 	try:
-		opts, args = getopt.getopt( sys.argv[1:], 'a:d:t:' )
+		opts, args = getopt.getopt( sys.argv[1:], 'a:d:j:t:x:' )
 		if len( args ) < 1 or len( args[0].strip() ) == 0:
 			sys.exit( 1 )
 
-		convert( args[0], opts )
+		convert( args[0], None, opts )
 	except getopt.GetoptError:
 		exit_code = 1
 	sys.exit( exit_code )
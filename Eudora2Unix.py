@@ -16,6 +16,7 @@ from os.path import *
 import re
 import string
 import getopt
+import multiprocessing
 
 if sys.hexversion < 33686000:
 	sys.stderr.write( "Aborted: Python version must be at least 2.2.1" \
@@ -24,11 +25,14 @@ if sys.hexversion < 33686000:
 
 import Eudora2Mbox
 import EudoraTOC
+import EudoraLog
+import AppleSingleDouble
 
 OUT_SFX = '.E2U_OUT'
 ORIG_SFX = '.E2U_ORIG'
 re_mbx_sfx = re.compile( '(.*?)\.mbx$', re.IGNORECASE )
 re_toc_sfx = re.compile( '(.*?)\.toc$', re.IGNORECASE )
+re_apple_double = re.compile( '\._' )	# Mac OS X's resource fork files
 re_fol_sfx = re.compile( '(.*?)\.fol$', re.IGNORECASE )
 re_out_sfx = re.compile( '(.*?)\.e2p_out$', re.IGNORECASE )
 re_in = re.compile( 'in\.mbx', re.IGNORECASE )
@@ -41,11 +45,20 @@ attachments_handled_by = {}
 
 embedded_dir = None
 
+# With -j, mailboxes are converted by a pool of that many worker
+# processes: convert_files() leaves them in pending_mailboxes, and
+# convert_pending() converts them all once the tree has been walked.
+# Big mailboxes are each split among the workers instead; see
+# Eudora2Mbox.chunk_workers.
+
+workers = 1
+pending_mailboxes = []
+
 # --------------------- Comments & complaints ----------------------
 def usage_complaint( arg ):
 	return [
 	'Usage error; specify Eudora directory to be converted:',
-	'   ' + arg + ' [-a attachments directory] [-f mbox|maildir|mmdf|mh|babyl] [-d target directory] eudora_directory [kmail|pine]'
+	'   ' + arg + ' [-a attachments directory] [-f mbox|maildir|mmdf|mh|babyl] [-d target directory] [-j workers] [-x attachment store directory] eudora_directory [kmail|pine]'
 	]
 
 def target_directory_already_exists_complaint( maildir ):
@@ -255,18 +268,31 @@ def convert_directory( eudoradir, opts ):
 	does a few cd's (change directory) and must therefore be able to come
 	back where it came from.
 	"""
-	global isMac
+	global isMac, workers
 
 	target = 'pine'
 	targetdir = ''
 	attachments_dirs = []
-	for f, v in opts:
+	attachment_store = None
+	for i, ( f, v ) in enumerate( opts ):
 		if f == '-t':
 			target = v.strip().lower()
 		elif f == '-d':
 			targetdir = v.strip()
 		elif f == '-a':
 			attachments_dirs = v.strip().split(':')
+		elif f == '-x':
+			# we chdir() below
+			attachment_store = abspath( v.strip() )
+			opts[i] = ( f, attachment_store )
+		elif f == '-j':
+			try:
+				workers = int( v )
+			except ValueError:
+				workers = 0
+			if workers < 1:
+				complain( usage_complaint( sys.argv[0] ) )
+				sys.exit( 1 )
 	if targetdir == '':
 		if target == 'kmail':
 			targetdir = 'Mail'
@@ -288,9 +314,14 @@ def convert_directory( eudoradir, opts ):
 
 	eudoradir = abspath( eudoradir )
 
-	if os.path.exists(eudoradir + os.sep + "Embedded"):
-		global embedded_dir
-		embedded_dir = eudoradir + os.sep + "Embedded"
+	# Windows Eudora keeps embedded content in Embedded, Mac Eudora
+	# in the Parts Folder
+
+	for name in ( "Embedded", "Parts Folder" ):
+		if os.path.isdir(eudoradir + os.sep + name):
+			global embedded_dir
+			embedded_dir = eudoradir + os.sep + name
+			break
 
 	if isdir( maildir ):
 		complain( target_directory_already_exists_complaint( maildir ) )
@@ -344,6 +375,7 @@ def convert_directory( eudoradir, opts ):
 
 	inform( beginning_conversion_remarks( maildir ) )
 	walk( maildir, convert_files, opts )
+	convert_pending( opts )
 
 	inform( moving_converted_remarks( maildir ) )
 	if target == 'pine':
@@ -360,7 +392,7 @@ def convert_directory( eudoradir, opts ):
 		inform( windows_concluding_remarks() )
 	inform( concluding_remarks( target, targetdir ) )
 
-	show_attachment_stats()
+	show_attachment_stats( attachment_store )
 
 	sys.exit( 0 )
 
@@ -371,14 +403,14 @@ def scan_attachment_dirs(attachments_dirs):
 		fullpaths = [adir + "/" + dirname for dirname in os.listdir(adir)]
 		attachments_not_handled = attachments_not_handled.union(fullpaths)
 
-def show_attachment_stats():
+def show_attachment_stats( attachment_store = None ):
 	"""Writes a report on attachment handling to attachlog.txt."""
 
 	global attachments_not_handled, attachments_handled_by
 
 	common_names = set()
-	common_names = common_names.union(Eudora2Mbox.found_attachments.keys())
-	common_names = common_names.union(Eudora2Mbox.missing_attachments.keys())
+	common_names = common_names.union(Eudora2Mbox.conversion.found_attachments.keys())
+	common_names = common_names.union(Eudora2Mbox.conversion.missing_attachments.keys())
 
 	total_missing = 0
 	total_attachments_listed = 0
@@ -396,12 +428,12 @@ def show_attachment_stats():
 			OUT.write(k)
 			OUT.write("\n\n")
 
-			if k in Eudora2Mbox.found_attachments:
+			if k in Eudora2Mbox.conversion.found_attachments:
 #				OUT.write("\tFound Attachments:\n")
 #				OUT.write("\t==================\n")
 
 				writenewline = False
-				for (desc, filename) in Eudora2Mbox.found_attachments[k]:
+				for (desc, filename) in Eudora2Mbox.conversion.found_attachments[k]:
 					total_attachments_listed = total_attachments_listed + 1
 					total_attachments_found = total_attachments_found + 1
 					try:
@@ -415,12 +447,12 @@ def show_attachment_stats():
 
 				if writenewline:
 					OUT.write("\n")
-			if k in Eudora2Mbox.missing_attachments:
+			if k in Eudora2Mbox.conversion.missing_attachments:
 				OUT.write("\tMissing Attachments:\n")
 				OUT.write("\t====================\n")
 
 				i = 1
-				for desc in Eudora2Mbox.missing_attachments[k]:
+				for desc in Eudora2Mbox.conversion.missing_attachments[k]:
 					OUT.write("\t%d.   %s\n" % (i, desc))
 					i = i+1
 					total_missing = total_missing + 1
@@ -435,18 +467,23 @@ def show_attachment_stats():
 			OUT.write(str(i) + ".   " + filename + "\n")
 			i = i+1
 
-		OUT.write("\n\n                         Total Number of Messages Processed: " + str(Eudora2Mbox.message_count) + "\n")
+		OUT.write("\n\n                         Total Number of Messages Processed: " + str(Eudora2Mbox.conversion.message_count) + "\n")
 		OUT.write("                         Total Number of Attachments Referenced: " + str(total_attachments_listed) + "\n")
 		OUT.write("                         Total Number of Attachments Successfully Found: " + str(total_attachments_found) + "\n")
 		OUT.write("                         Total Count of Attachments Referenced in Email That Are Missing : " + str(total_missing) + "\n")
+		OUT.write("                         Attachment Files Encoded: " + str(Eudora2Mbox.conversion.part_cache_misses) + ", Reused From the Cache: " + str(Eudora2Mbox.conversion.part_cache_hits) + "\n")
+		if attachment_store:
+			OUT.write("                         Attachment Files Stored in " + attachment_store + ": " + str(Eudora2Mbox.conversion.store_added) + ", Already There: " + str(Eudora2Mbox.conversion.store_reused) + "\n")
 		OUT.write("------------------------------------------------------------------------------------------------------------------------\n")
 
 		OUT.write("\n------------------------------------------------------------------------------------------------------------------------\n")
 		OUT.write("                                           Mangled Mac Names\n\n")
 
 		i = 1
-		for filename in Eudora2Mbox.mac_mismatches:
+		for filename in Eudora2Mbox.conversion.mac_mismatches:
 			OUT.write(str(i) + ".   " + filename + "\n")
+			for candidate in Eudora2Mbox.conversion.mac_candidates.get(filename, []):
+				OUT.write("\tmaybe " + candidate + "\n")
 			i = i+1
 
 		OUT.write("------------------------------------------------------------------------------------------------------------------------\n")
@@ -535,6 +572,10 @@ def move_special_mbox( dir, targetname, suffix, namelist ):
 			t_toc = t_nombx + '.toc'
 			if isfile( f_toc ):
 				moveFile( f_toc, t_toc )
+			# where a Mac mailbox's toc may be instead
+			f_sidecar = AppleSingleDouble.sidecar( fpath )
+			if isfile( f_sidecar ):
+				moveFile( f_sidecar, AppleSingleDouble.sidecar( t_mbx ) )
 
 def convert_files( avoid_dirlist, dir, names ):
 	"""
@@ -573,44 +614,43 @@ def convert_files( avoid_dirlist, dir, names ):
 	will be the unix mbox.
 	Analyze by diffing with (e.g. diff-ing against the .E2U_ORIG version).
 	"""
-	# avoid any directory specified with a '-a' flag
+	# avoid any directory specified with a '-a' flag, and the
+	# attachment store (-x) should it be in the mail directory
 	for f, v in opts:
 		if f == '-a':
 			attachments_dirs = v.split(':')
 			for adir in attachments_dirs:
 				if samefile( dir, adir ):
 					return
+		elif f == '-x':
+			store = realpath( v )
+			if realpath( dir ) == store or realpath( dir ).startswith( store + os.sep ):
+				return
 	descmap = parse_descmap( dir )
 	for f in names:
 		fpath = join( dir, f )
 		f_targ = join( dir, get_eudora_boxname( f, descmap, isMac ) );
 		if( isfile( fpath ) and ( isMac or re_mbx_sfx.match( f ) ) 
-					and not re_toc_sfx.match( f ) ):
+					and not re_toc_sfx.match( f )
+					and not re_apple_double.match( f ) ):
 			f_nombx = re_mbx_sfx.sub( '\\1', fpath )
 			f_out = f_nombx + OUT_SFX 
 			f_orig = f_nombx + ORIG_SFX 
 			f_toc = f_nombx + '.toc'
-			if exists( f_toc ):
+			# Eudora2Mbox reads the toc itself; the text
+			# version is only written out for debugging
+			if exists( f_toc ) and EudoraLog.verbose >= 3:
 				try:
-#					os.spawnlpe( os.P_WAIT, 'etoc', 'etoc',
-#						f_toc, f_toc + '.txt',
-#						os.environ )
 					EudoraTOC.parse( f_toc, f_toc + '.txt' )
-				except OSError, ( errno, str ):
-					complain( toc_complaint( f_toc, str ) )
+				except EudoraTOC.TOCError, errstr:
+					complain( toc_complaint( f_toc, str( errstr ) ) )
 			moveFile( fpath, f_nombx )
 			global embedded_dir
-			Eudora2Mbox.convert( f_nombx, embedded_dir, opts )
-			file1 = f_nombx + ".new"
-			file2 = f_nombx
-
-			print "------Hey, I'm moving %s to %s\n" % (file1, file2)
-			moveFile( f_nombx + ".new", f_nombx )
-
-			if exists( f_nombx + ".toc" ):
-				removeFile( f_nombx + ".toc" )
-				removeFile( f_nombx + ".toc.txt" )
-			print
+			if workers > 1:
+				pending_mailboxes.append( f_nombx )
+			else:
+				Eudora2Mbox.convert( f_nombx, embedded_dir, opts )
+				converted( f_nombx )
 
 def parse_descmap( dir ):
 	"""Eudora Windows mailbox folders have associated 'descmap.pce' file,
@@ -707,11 +747,71 @@ def fix_file_permissions( arg, dir, names ):
 		elif isdir( f ):
 			os.chmod( fpath, 0700 )
 
+def converted( f_nombx ):
+	"""Puts the converted mailbox in place of the Eudora one."""
+	file1 = f_nombx + ".new"
+	file2 = f_nombx
+
+	print "------Hey, I'm moving %s to %s\n" % (file1, file2)
+	moveFile( f_nombx + ".new", f_nombx )
+
+	if exists( f_nombx + ".toc" ):
+		removeFile( f_nombx + ".toc" )
+	if exists( f_nombx + ".toc.txt" ):
+		removeFile( f_nombx + ".toc.txt" )
+	if exists( AppleSingleDouble.sidecar( f_nombx ) ):
+		removeFile( AppleSingleDouble.sidecar( f_nombx ) )
+	print
+
+def convert_pending( opts ):
+	"""
+	Converts the pending_mailboxes with a pool of worker processes,
+	the biggest first, so that a big one isn't left till last.  What
+	each worker found is merged into Eudora2Mbox.conversion in the
+	order the mailboxes were found, as if they'd been converted one
+	after another, so the report in attachlog.txt comes out the same,
+	but for the part cache counts: each worker has a part cache of its
+	own, so a file attached in mailboxes that different workers convert
+	is encoded by each, not reused.
+
+	Mailboxes bigger than Eudora2Mbox.chunk_threshold are converted
+	first, one at a time, each split among the workers by
+	Eudora2Mbox.convert(), since a worker can't have workers of its own.
+	"""
+	if not pending_mailboxes:
+		return
+
+	jobs = [ ( f_nombx, embedded_dir, opts ) for f_nombx in pending_mailboxes ]
+	order = sorted( range( len( jobs ) ),
+		key = lambda i: -getsize( pending_mailboxes[i] ) )
+	results = [ None ] * len( jobs )
+
+	while order and getsize( pending_mailboxes[order[0]] ) > Eudora2Mbox.chunk_threshold:
+		i = order.pop( 0 )
+		results[i] = Eudora2Mbox.convert_worker( jobs[i] )
+
+	pool = multiprocessing.Pool( workers )
+	try:
+		done = pool.imap( Eudora2Mbox.convert_worker, [ jobs[i] for i in order ] )
+		for i in order:
+			results[i] = done.next()
+		pool.close()
+	except:
+		pool.terminate()
+		raise
+	finally:
+		pool.join()
+
+	for ( f_nombx, found ) in zip( pending_mailboxes, results ):
+		Eudora2Mbox.conversion.merge( found )
+		converted( f_nombx )
+	del pending_mailboxes[:]
+
 # --------------------- START HERE --------------------------------
 # Note: in this rather stupid implementation of getopts, has to go
 # program flags args, or else
 try:
-	opts, args = getopt.getopt( sys.argv[1:], 'a:d:t:' )
+	opts, args = getopt.getopt( sys.argv[1:], 'a:d:j:t:x:' )
 except getopt.GetoptError:
 	complain( usage_complaint( sys.argv[0] ) )
 	sys.exit( 1 )
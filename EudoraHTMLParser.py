@@ -1,6 +1,7 @@
 import os
 import re
 from HTMLParser import HTMLParser, HTMLParseError
+import HTMLParser as _htmlparser
 
 class EudoraHTMLParser(HTMLParser):
 
@@ -24,4 +25,144 @@ class EudoraHTMLParser(HTMLParser):
 	def get_cids(self):
 		return self.cids
 
+# scan_cids() skips over text, end tags, references and start tags
+# other than img, script and style (whose contents aren't markup) with
+# one match of _re_plain, and looks at what's left one piece at a time,
+# as HTMLParser does.  It uses HTMLParser's own patterns, so that it
+# sees the same tags as HTMLParser would.  The lookahead and \1 around
+# locatestarttagend take the match HTMLParser would, and no other.
 
+_re_plain = re.compile(r'''(?:[^&<]+
+	|(?!<(?:[iI][mM][gG]|[sS][cC][rR][iI][pP][tT]|[sS][tT][yY][lL][eE])[\t\n\r\f\ />\x00])
+		(?=(''' + _htmlparser.locatestarttagend.pattern + r'''))\1>
+	|</[^>]*>
+	|&\#(?:[0-9]+|[xX][0-9a-fA-F]+)(?=[^0-9a-fA-F])
+	|&[a-zA-Z][-.a-zA-Z0-9]*(?=[^a-zA-Z0-9])
+	|&(?=[^a-zA-Z\#])
+	)*''', re.VERBOSE)
+_cdata_ends = {}
+_unescaper = HTMLParser()
+
+def scan_cids(text):
+	"""
+	Returns what get_cids() would after text was fed to an
+	EudoraHTMLParser, finding it in one pass over text without the
+	parser's handling of every tag, piece of text and reference in it;
+	see _re_plain.
+
+	Returns None when text holds something the parser might fail on:
+	a marked section ('<![' ...), which it raises HTMLParseError for if
+	it doesn't know the keyword, or an img src with no value.  The
+	parser is needed for those.
+
+	Like the parser, it stops where the parser would wait for more
+	text: at an unfinished tag, comment or reference.
+	"""
+	p = _htmlparser
+	cids = []
+	n = len(text)
+	i = 0
+	while i < n:
+		i = _re_plain.match(text, i).end()
+		if i == n:
+			break
+		if text.startswith('&', i):
+			if text.startswith('&#', i):
+				if not p.charref.match(text, i):
+					break
+			elif not p.entityref.match(text, i):
+				if p.incomplete.match(text, i) or i + 1 == n:
+					break
+			i = i + 1
+		elif p.starttagopen.match(text, i):
+			endpos = _start_tag_end(text, i)
+			if endpos < 0:
+				break
+			match = p.tagfind.match(text, i + 1)
+			tag = match.group(1).lower()
+			if tag == 'img' or tag in HTMLParser.CDATA_CONTENT_ELEMENTS:
+				(attrs, end) = _start_tag_attrs(text, match.end(), endpos, tag == 'img')
+				if end not in ('>', '/>'):
+					pass		# the parser takes it for text
+				elif tag == 'img':
+					for k, v in attrs:
+						if k == 'src':
+							if v is None:
+								return None
+							if v.startswith('cid:') or (not v.startswith('http://')
+									and not v.startswith('https://')):
+								cids.append(v)
+				elif end == '>':
+					if tag not in _cdata_ends:
+						_cdata_ends[tag] = re.compile(r'</\s*%s\s*>' % tag, re.I)
+					close = _cdata_ends[tag].search(text, endpos)
+					if not close:
+						break
+					endpos = close.end()
+			i = endpos
+		elif text.startswith('</', i):
+			match = p.endendtag.search(text, i + 1)
+			if not match:
+				break
+			i = match.end()
+		elif text.startswith('<!--', i):
+			match = p.commentclose.search(text, i + 4)
+			if not match:
+				break
+			i = match.end()
+		elif text.startswith('<?', i):
+			match = p.piclose.search(text, i + 2)
+			if not match:
+				break
+			i = match.end()
+		elif text.startswith('<![', i):
+			return None
+		elif text.startswith('<!', i):
+			if text[i:i + 9].lower() == '<!doctype':
+				gtpos = text.find('>', i + 9)
+			else:
+				gtpos = text.find('>', i + 2)
+			if gtpos < 0:
+				break
+			i = gtpos + 1
+		elif i + 1 < n:
+			i = i + 1
+		else:
+			break
+	return cids
+
+def _start_tag_end(text, i):
+	"""HTMLParser's check_for_whole_start_tag(): the end of the start
+	tag at i, or -1 if it's unfinished."""
+	j = _htmlparser.locatestarttagend.match(text, i).end()
+	next = text[j:j + 1]
+	if next == '>':
+		return j + 1
+	if next == '/':
+		if text.startswith('/>', j):
+			return j + 2
+		return -1
+	if next == '' or next in ('abcdefghijklmnopqrstuvwxyz=/'
+				'ABCDEFGHIJKLMNOPQRSTUVWXYZ'):
+		return -1
+	return j
+
+def _start_tag_attrs(text, k, endpos, unescape):
+	"""HTMLParser's parse_starttag(): the attributes of a start tag
+	from k, after its name, and what's left before endpos."""
+	attrs = []
+	while k < endpos:
+		m = _htmlparser.attrfind.match(text, k)
+		if not m:
+			break
+		attrname, rest, attrvalue = m.group(1, 2, 3)
+		if not rest:
+			attrvalue = None
+		elif attrvalue[:1] == '\'' == attrvalue[-1:] or \
+		     attrvalue[:1] == '"' == attrvalue[-1:]:
+			attrvalue = attrvalue[1:-1]
+		if attrvalue and unescape:
+			attrvalue = _unescaper.unescape(attrvalue)
+		attrs.append((attrname.lower(), attrvalue))
+		k = m.end()
+	return (attrs, text[k:endpos].strip())
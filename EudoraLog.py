@@ -30,14 +30,16 @@ class Log:
 	"""A log dedicated to a specific Eudora2Mbox mail box that we
 	are converting.  Records messages in it (depending on
 	verbosity, also prints on stdout), summarizes messages
-	recorded, and closes file."""
+	recorded, and closes file.  The files are named after path, if
+	given, rather than after the mail box."""
 
 	total_msgs = 0
 	exit_code = 0
 
 
-	def __init__(self, mbx):
+	def __init__(self, mbx, path=None):
 		self.mbxname = mbx
+		self.path = path or mbx
 		self.log_msgs = 0
 		self.warn_msgs = 0
 		self.error_msgs = 0
@@ -75,18 +77,43 @@ class Log:
 		    self._summary(self.error_msgs, 'error') + os.linesep
 
 	def log(self, msg):
-		self.record(self.mbxname + LOG_SFX, msg, 3)
+		self.record(self.path + LOG_SFX, msg, 3)
 		self.log_msgs += 1
 
 	def warn(self, msg):
-		self.record(self.mbxname + WARN_SFX, msg, 2)
+		self.record(self.path + WARN_SFX, msg, 2)
 		self.warn_msgs += 1
 		Log.exit_code = 1
 
 	def error(self, msg):
-		self.record(self.mbxname + ERR_SFX, msg, 1)
+		self.record(self.path + ERR_SFX, msg, 1)
 		self.error_msgs += 1
 		Log.exit_code = 1
 
 	def mbx_name(self):
 		return self.mbxname
+
+	def join(self, other):
+		"""Adds the messages recorded in other, a log of part of the
+		same mail box kept in files of its own, to this one, and
+		removes its files."""
+		for sfx in (LOG_SFX, WARN_SFX, ERR_SFX):
+			filename = other.path + sfx
+			if not os.path.exists(filename):
+				continue
+			IN = open(filename, 'rb')
+			try:
+				OUT = open(self.path + sfx, 'ab')
+				try:
+					OUT.write(IN.read())
+				finally:
+					OUT.close()
+			finally:
+				IN.close()
+			os.remove(filename)
+		self.log_msgs += other.log_msgs
+		self.warn_msgs += other.warn_msgs
+		self.error_msgs += other.error_msgs
+		Log.total_msgs += other.log_msgs + other.warn_msgs + other.error_msgs
+		if other.warn_msgs or other.error_msgs:
+			Log.exit_code = 1
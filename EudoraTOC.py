@@ -3,16 +3,24 @@
 """
 For interpreting Eudora mailbox '.toc' files.
 
+TOC loads a toc into memory for the converter; parse() prints it
+out as a '.toc.txt' text file, for debugging; query() answers questions
+about the tocs of a whole Eudora tree ('EudoraTOC.py query ...'), and
+check() how well they agree with their mailboxes ('EudoraTOC.py check').
+
 Structure elements are read as characters because integers are all
 big-endian (like the Mac), and I want this to run on little-ending
 machines (like the IBM PC).
 
-This code could be much improved by making use of Python's built-
-in endian struct declarations
+TOC makes use of Python's built-in endian struct declarations
+instead; parse() could be much improved by doing the same.
 
 Note that some Mac versions keep the toc info in the resource forks
-of the mailbox files.  This info has to be put in a toc file before
-this script can work.  A utilitiy for doing this is available at
+of the mailbox files.  Where the mail folder has been copied off the
+Mac, the resource fork is in the '._' AppleDouble file beside the
+mailbox, and resource_toc() reads the toc from there.  Otherwise the
+info has to be put in a toc file before this script can work.  A
+utilitiy for doing this is available at
 <ftp://ftp.eudora.com/eudora/eudoralight/mac/extras/utils/TOCConvert.sea.hqx>
 
 For Windows Eudora TOC file format, see
@@ -25,9 +33,15 @@ __author__ = "Stevan White <Stevan_White@hotmail.com>"
 __date__ = "2003-03-06"
 __version__ = "1.3"
 import sys
+import os
 import re
+import time
+import calendar
 import string
+import AppleSingleDouble
 from struct import *
+from array import array
+from itertools import izip
 
 if sys.hexversion < 33686000:
 	sys.stderr.write( "Aborted: Python version must be at least 2.2.1" \
@@ -95,7 +109,7 @@ mac_entry = string.join( (
 	'B',	# status ... & 1 = U, & 2 = R, & 4 = & 8 = S
 	'x',	# Date length
 	'32s',	# Date (0-terminated?)
-	'6x',	# 
+	'6x',	# (Eudora 6: seconds since 1904 of the Date header, then 2x)
 	'x',	# misc: "bla" or "full headers" if value is 8
 	'x',	# 
 	'8x',	# window size
@@ -136,6 +150,29 @@ win_entry = string.join( (
 # WIN_EUDORA_LITE_1 = 0x2a00
 # WIN_EUDORA_5 = 0x0300
 
+# The Status header values the status fields stand for; any other status
+# leaves the Status header alone.  See printMacEntry() and printWinEntry().
+
+mac_status = { 0x1: 'O', 0x2: 'OR', 0x3: 'OR', 0x4: 'OR', 0x8: 'OR', 0x9: 'OR' }
+win_status = { 0x1: 'O', 0x2: 'OR', 0x3: 'OR', 0x4: 'OR' }
+
+# What the status fields mean, from the comments in printMacEntry() and
+# printWinEntry(); for the query command.  A message Windows Eudora has
+# done nothing with yet has status 0, where the Mac has 0x1 (as the
+# same messages in the test folders show), so both are 'unread'.
+
+mac_status_names = { 0x1: 'unread', 0x2: 'read', 0x3: 'replied',
+	0x4: 'redirected', 0x8: 'forwarded', 0x9: 'sent', 0xa: 'unsent' }
+win_status_names = { 0x0: 'unread', 0x1: 'unread', 0x2: 'replied', 0x3: 'forwarded',
+	0x4: 'redirected', 0x5: 'rebuilt', 0x6: 'saved', 0x7: 'queued',
+	0x8: 'sent', 0x9: 'unsent', 0xa: 'time queued' }
+
+mac_seconds = Struct( '>46xL' )	# see mac_entry
+mac_epoch = 2082844800		# seconds from 1904 to 1970
+re_win_date = re.compile(	# as in '11:42 PM 12/12/2010'
+	r'(\d\d?):(\d\d) ([AP])M (\d\d?)/(\d\d?)/(\d{4})$' )
+win_dates = {}	# the seconds() of each date seen, as it's to the minute
+
 # Just a guess: maybe Mac and Windows are distinguished thus (with 0 being Mac)
 def isMac( version ):
 	MAC = 0x00FF
@@ -167,11 +204,10 @@ def unpackstr( str, i = 0 ):
 	""" got from comp.lang.python Michael P. Reilly 1999/05/14 """
 	if not str:
 		return None
-	for c in str:
-		if c == '\000':
-			break
-		i = i + 1
-	return str[:i]
+	end = str.find( '\000' )
+	if end < 0:
+		end = len( str )
+	return str[:i + end]
 
 def printMacFolder( out, folder ):
 	( version, nlen, name ) = unpack( mac_folder, folder )
@@ -347,9 +383,470 @@ def parse( infile, outfile = None ):
 
 	return returnVal
 
-if sys.argv[0].find( 'EudoraTOC.py' ) > -1:	# i.e. if script called directly
+# The numeric fields of an entry, as struct formats in the right byte
+# order, with everything else skipped: offset, length, status, priority.
+
+mac_numbers = '>II4xB49xB'
+win_numbers = '<II4xBx2xB'
+
+block_entries = 1024
+block_structs = {}
+
+def block_struct( byte_order, stride ):
+	"""A compiled struct for the numbers of block_entries entries."""
+	format = byte_order + stride
+	try:
+		return block_structs[format]
+	except KeyError:
+		block = Struct( byte_order + stride * block_entries )
+		block_structs[format] = block
+		return block
+
+class TOC:
+	"""
+	A Eudora '.toc' file read straight into memory, rather than through
+	a '.toc.txt' file as printed by parse().
+
+	The whole file is read at once, and the numeric fields of all its
+	entries unpacked by a single precompiled struct into the arrays
+	offsets, lengths, statuses and priorities, indexed by entry
+	number.  Date, To and Subject are only decoded from the entry
+	when asked for.  A short entry at the end is junk, and ignored.
+
+	If data is given, it is taken for the contents of the toc, and
+	infile is not read.
+	"""
+	def __init__( self, infile, data = None ):
+		if data is None:
+			try:
+				file = open( infile, "rb" )
+			except IOError, ( errno, strerror ):
+				raise TOCError( strerror )
+			try:
+				data = file.read()
+			finally:
+				file.close()
+		self.data = data
+
+		if len( self.data ) < 2:
+			raise TOCError( "EudoraTOC: couldn't read header" )
+		self.version = unpack( '>H', self.data[:2] )[0]
+
+		if isMac( self.version ):
+			self.mac = True
+			foldersize = calcsize( mac_folder )
+			self.entry = Struct( mac_entry )
+			numbers = mac_numbers
+		elif isWin( self.version ):
+			self.mac = False
+			foldersize = calcsize( win_folder )
+			self.entry = Struct( win_entry )
+			numbers = win_numbers
+		else:
+			raise TOCError( "EudoraTOC: unknown toc version: 0x%x" \
+							% self.version )
+
+		if len( self.data ) < foldersize:
+			raise TOCError( "EudoraTOC: couldn't read header" )
+		self.start = foldersize
+		self.count = ( len( self.data ) - foldersize ) / self.entry.size
+
+		# Python 2 has no iter_unpack; instead, the numbers' format is
+		# repeated over the stride of an entry, for a block of entries.
+		stride = numbers[1:] + '%dx' % ( self.entry.size - calcsize( numbers ) )
+		self.offsets = array( 'L' )
+		self.lengths = array( 'L' )
+		self.statuses = array( 'B' )
+		self.priorities = array( 'B' )
+		pos = foldersize
+		left = self.count
+		while left:
+			n = min( left, block_entries )
+			block = Struct( numbers[0] + stride * n ) if n < block_entries \
+				else block_struct( numbers[0], stride )
+			values = block.unpack_from( self.data, pos )
+			self.offsets.extend( values[0::4] )
+			self.lengths.extend( values[1::4] )
+			self.statuses.extend( values[2::4] )
+			self.priorities.extend( values[3::4] )
+			pos += block.size
+			left -= n
+
+	def __len__( self ):
+		return self.count
+
+	def index( self ):
+		"""
+		Returns a dictionary mapping the offset of each message in the
+		mailbox to its entry number.  Where two entries claim the same
+		offset, the later one wins.
+		"""
+		return dict( izip( self.offsets, xrange( self.count ) ) )
+
+	def spans( self, index = None ):
+		"""
+		Returns the ( offset, length ) of each message, in mailbox
+		order, taking the entries in index (see index()) if given.
+		"""
+		if index is None:
+			index = self.index()
+		lengths = self.lengths
+		spans = [ ( offset, lengths[i] ) for ( offset, i ) in index.iteritems() ]
+		spans.sort()
+		return spans
+
+	def priority( self, i ):
+		"""The priority of entry i, as parse() prints it."""
+		if self.mac:
+			return self.priorities[i] / 40
+		return self.priorities[i]
+
+	def status( self, i ):
+		"""The status of entry i as a Status header value, as parse()
+		prints it."""
+		if self.mac:
+			return mac_status.get( self.statuses[i], '' )
+		return win_status.get( self.statuses[i], '' )
+
+	def status_name( self, i ):
+		"""What the status of entry i means, or its value in hex."""
+		if self.mac:
+			names = mac_status_names
+		else:
+			names = win_status_names
+		return names.get( self.statuses[i], '0x%x' % self.statuses[i] )
+
+	def seconds( self, i ):
+		"""
+		The date of entry i in seconds since 1970 UTC, or None if there
+		is none.  Mac Eudora keeps the Date header's time, in UTC;
+		Windows Eudora only the date it shows, to the minute, in its
+		local time, which is taken to be the local time here (set TZ to
+		the time zone Eudora ran in, if that was elsewhere).
+		"""
+		if self.mac:
+			t = mac_seconds.unpack_from( self.data,
+					self.start + i * self.entry.size )[0]
+			if t:
+				return t - mac_epoch
+			return None
+		date = self.date( i )
+		try:
+			return win_dates[date]
+		except KeyError:
+			pass
+		m = re_win_date.match( date or '' )
+		if m:
+			( hour, minute, pm, month, day, year ) = m.groups()
+			hour = int( hour ) % 12
+			if pm == 'P':
+				hour += 12
+			try:
+				t = int( time.mktime( ( int( year ), int( month ),
+					int( day ), hour, int( minute ), 0, 0, 0, -1 ) ) )
+			except ( OverflowError, ValueError ):
+				t = None
+		else:
+			t = None
+		if len( win_dates ) > 100000:
+			win_dates.clear()
+		win_dates[date] = t
+		return t
+
+	def fields( self, i ):
+		return self.entry.unpack_from( self.data,
+					self.start + i * self.entry.size )
+
+	def date( self, i ):
+		if self.mac:
+			return unpackstr( self.fields( i )[3] )
+		return unpackstr( self.fields( i )[4] )
+
+	def to( self, i ):
+		f = self.fields( i )
+		if self.mac:
+			return f[6][:f[5]]
+		return unpackstr( f[5] )
+
+	def subject( self, i ):
+		f = self.fields( i )
+		if self.mac:
+			return f[8][:f[7]]
+		return unpackstr( f[6] )
+
+# Mac Eudora keeps the toc in the mailbox's 'TOCF' resource 1001; we've
+# seen another, stale one beside it.
+
+toc_resource = 1001
+
+def resource_toc( mbx ):
+	"""
+	Read the toc Mac Eudora keeps in the resource fork of the mailbox
+	mbx, from the AppleDouble file beside it.  Returns a TOC, made from
+	the 'TOCF' resource toc_resource if there is one, otherwise the
+	first 'TOCF' resource there is.
+	"""
+	path = AppleSingleDouble.sidecar( mbx )
+	try:
+		apple = AppleSingleDouble.AppleFile( path )
+	except AppleSingleDouble.AppleFileError, e:
+		raise TOCError( str( e ) )
+
+	data = None
+	try:
+		try:
+			for ( id, name, toc ) in apple.resources( 'TOCF' ):
+				if data is None or id == toc_resource:
+					data = toc
+				if id == toc_resource:
+					break
+		except AppleSingleDouble.AppleFileError, e:
+			raise TOCError( str( e ) )
+	finally:
+		apple.close()
+
+	if data is None:
+		raise TOCError( "EudoraTOC: no 'TOCF' resource in " + path )
+	return TOC( path, data )
+
+re_toc_sfx = re.compile( '(.*?)\.toc$', re.IGNORECASE )
+
+def find_tocs( top ):
+	"""
+	Generates the ( mailbox, toc ) of each mailbox under the directory
+	top that has a toc, without opening any mailbox: its '.toc' file
+	or, failing that, for a Mac mailbox, the 'TOCF' resource in the
+	AppleDouble file beside it.  A toc file named instead of a directory
+	is read by itself.  Toc files that can't be read are complained
+	about and skipped; AppleDouble files without a toc are skipped
+	quietly, since most belong to files other than mailboxes.
+	"""
+	if os.path.isfile( top ):
+		found = [ ( os.path.dirname( top ), os.path.basename( top ) ) ]
+		names = ()
+	else:
+		found = []
+		for ( dir, dirs, files ) in os.walk( top ):
+			dirs.sort()
+			files.sort()
+			found.extend( [ ( dir, f ) for f in files ] )
+		names = set( [ os.path.join( dir, f ) for ( dir, f ) in found ] )
+	for ( dir, f ) in found:
+		path = os.path.join( dir, f )
+		try:
+			if f.startswith( '._' ):
+				mbx = os.path.join( dir, f[2:] )
+				if mbx not in names or mbx + '.toc' in names:
+					continue
+				try:
+					toc = resource_toc( mbx )
+				except TOCError:
+					continue
+			elif re_toc_sfx.match( f ):
+				mbx = re_toc_sfx.sub( '\\1', path )
+				toc = TOC( path )
+			else:
+				continue
+		except TOCError, e:
+			print >> sys.stderr, "EudoraTOC: couldn't read %s: %s" \
+							% ( path, e.args )
+			continue
+		yield ( mbx, toc )
+
+query_usage = """usage: EudoraTOC.py query [options] folder-or-toc ...
+Answers questions about Eudora mailboxes from their tocs alone.
+  -s status   only messages with this status (e.g. unread, read, sent)
+  -S regexp   only messages whose Subject matches
+  -T regexp   only messages whose To matches
+  -a date     only messages dated on or after date (YYYY-MM-DD)
+  -b date     only messages dated before date (YYYY-MM-DD)
+  -l          list the messages, rather than summarize each mailbox
+  -j          print JSON rather than a table
+Dates and times are in UTC, days included.  Windows tocs only hold the
+local time Eudora showed; it is taken to be in the local time zone here,
+so set TZ to the one Eudora ran in if that was elsewhere."""
+
+def query_day( day ):
+	return calendar.timegm( time.strptime( day, '%Y-%m-%d' ) )
+
+def query_date( seconds ):
+	if seconds is None:
+		return None
+	return time.strftime( '%Y-%m-%d %H:%M', time.gmtime( seconds ) )
+
+def query( args ):
+	"""
+	The query command: counts, status histograms, date ranges and
+	Subject and To filters over the tocs of a whole Eudora tree, with
+	no mailbox opened.  See query_usage.
+	"""
+	import getopt
+	try:
+		opts, args = getopt.getopt( args, 's:S:T:a:b:lj' )
+		status = subject = to = after = before = None
+		listing = as_json = False
+		for ( f, v ) in opts:
+			if f == '-s':
+				status = v
+			elif f == '-S':
+				subject = re.compile( v, re.IGNORECASE )
+			elif f == '-T':
+				to = re.compile( v, re.IGNORECASE )
+			elif f == '-a':
+				after = query_day( v )
+			elif f == '-b':
+				before = query_day( v )
+			elif f == '-l':
+				listing = True
+			elif f == '-j':
+				as_json = True
+		if not args:
+			raise getopt.GetoptError( 'no folder or toc given' )
+	except ( getopt.GetoptError, re.error, ValueError ), e:
+		print >> sys.stderr, 'EudoraTOC query: %s' % ( e, )
+		print >> sys.stderr, query_usage
+		return 2
+	dated = after is not None or before is not None
+
+	mailboxes = []
+	for top in args:
+		for ( mbx, toc ) in find_tocs( top ):
+			if os.path.isdir( top ):
+				mbx = os.path.relpath( mbx, top )
+			if toc.mac:
+				charset = 'mac_roman'
+			else:
+				charset = 'cp1252'
+			box = { 'mailbox': mbx, 'messages': len( toc ),
+				'matching': 0, 'status': {},
+				'first': None, 'last': None }
+			first = last = None
+			messages = []
+			for i in xrange( len( toc ) ):
+				# an empty mailbox's toc may hold a blank entry
+				if not toc.lengths[i]:
+					box['messages'] -= 1
+					continue
+				name = toc.status_name( i )
+				if status is not None and name != status:
+					continue
+				if subject and not subject.search( toc.subject( i ) or '' ):
+					continue
+				if to and not to.search( toc.to( i ) or '' ):
+					continue
+				seconds = toc.seconds( i )
+				if dated and ( seconds is None
+						or after is not None and seconds < after
+						or before is not None and seconds >= before ):
+					continue
+				box['matching'] += 1
+				box['status'][name] = box['status'].get( name, 0 ) + 1
+				if seconds is not None:
+					if first is None or seconds < first:
+						first = seconds
+					if last is None or seconds > last:
+						last = seconds
+				if listing:
+					messages.append( { 'date': query_date( seconds ),
+						'status': name,
+						'to': unicode( toc.to( i ) or '', charset, 'replace' ),
+						'subject': unicode( toc.subject( i ) or '',
+								charset, 'replace' ) } )
+			box['first'] = query_date( first )
+			box['last'] = query_date( last )
+			if listing:
+				box['list'] = messages
+			mailboxes.append( box )
+
+	total = { 'mailboxes': len( mailboxes ), 'messages': 0,
+		'matching': 0, 'status': {},
+		'first': min( [ box['first'] for box in mailboxes
+					if box['first'] ] or [ None ] ),
+		'last': max( [ box['last'] for box in mailboxes ] or [ None ] ) }
+	for box in mailboxes:
+		total['messages'] += box['messages']
+		total['matching'] += box['matching']
+		for ( name, count ) in box['status'].iteritems():
+			total['status'][name] = total['status'].get( name, 0 ) + count
+
+	if as_json:
+		import json
+		print json.dumps( { 'mailboxes': mailboxes, 'total': total },
+						indent = 1, sort_keys = True )
+		return 0
+
+	width = max( [ len( 'Mailbox' ) ]
+			+ [ len( box['mailbox'] ) for box in mailboxes ] )
+	if listing:
+		print '%-*s  %-16s  %-10s  %-24s  %s' \
+			% ( width, 'Mailbox', 'Date', 'Status', 'To', 'Subject' )
+		for box in mailboxes:
+			for m in box['list']:
+				print ( u'%-*s  %-16s  %-10s  %-24.24s  %s'
+					% ( width, box['mailbox'].decode( 'utf-8', 'replace' ),
+						m['date'] or '', m['status'], m['to'],
+						m['subject'] ) ).encode( 'utf-8' )
+		return 0
+
+	def histogram( counts ):
+		return string.join( [ '%s %d' % ( name, counts[name] )
+				for name in sorted( counts ) ], ', ' )
+
+	print '%-*s  %8s  %8s  %-16s  %-16s  %s' % ( width, 'Mailbox',
+		'Messages', 'Matching', 'First', 'Last', 'Status' )
+	for box in mailboxes:
+		print '%-*s  %8d  %8d  %-16s  %-16s  %s' % ( width,
+			box['mailbox'], box['messages'], box['matching'],
+			box['first'] or '', box['last'] or '',
+			histogram( box['status'] ) )
+	print '%-*s  %8d  %8d  %-16s  %-16s  %s' % ( width,
+		'Total (%d)' % total['mailboxes'], total['messages'],
+		total['matching'], total['first'] or '', total['last'] or '',
+		histogram( total['status'] ) )
+	return 0
+
+def check( args ):
+	"""
+	The check command: 'EudoraTOC.py check folder-or-toc ...' reports
+	how well each toc agrees with its mailbox (see Header.TOC_Health),
+	and so whether the converter will use it.  Returns 1 if any toc
+	can't be trusted.
+	"""
+	import Header	# which imports this module
+	if not args:
+		print >> sys.stderr, 'usage: EudoraTOC.py check folder-or-toc ...'
+		return 2
+	untrusted = 0
+	for top in args:
+		for ( mbx, toc ) in find_tocs( top ):
+			if not os.path.isfile( mbx ) and os.path.isfile( mbx + '.mbx' ):
+				mbx = mbx + '.mbx'
+			try:
+				file = open( mbx, 'rb' )
+			except IOError, ( errno, strerror ):
+				print '%s: %s' % ( mbx, strerror )
+				untrusted += 1
+				continue
+			try:
+				buf = Header.map_mailbox( file )
+				health = Header.TOC_Health( buf, toc.spans() )
+			finally:
+				file.close()
+			if health.trusted():
+				verdict = 'trusted'
+			else:
+				verdict = 'NOT TRUSTED'
+				untrusted += 1
+			print '%s: %s, %s' % ( mbx, verdict, health )
+	return untrusted and 1
+
+if __name__ == '__main__':	# i.e. if script called directly, not imported
 	if len( sys.argv ) < 2:
 		raise TOCError( "EudoraTOC: insufficient arguments" )
+	if sys.argv[1] == 'query':
+		sys.exit( query( sys.argv[2:] ) )
+	if sys.argv[1] == 'check':
+		sys.exit( check( sys.argv[2:] ) )
 	if len( sys.argv ) >= 3:
 		outfile = sys.argv[2]
 	else:
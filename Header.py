@@ -6,8 +6,11 @@ Classes for handling Eudora Mailbox header parsing and clean up.
 import os
 import re
 import time
+import mmap
 import string
 import EudoraLog
+import EudoraTOC
+import AppleSingleDouble
 
 # Configuration.
 
@@ -64,6 +67,221 @@ def strip_linesep( line ):
 		line = line[0:-1]
         return line
 
+re_crs_before_newline = re.compile( r'\r+\n' )
+
+def normalize_linesep( text, nl = '\n' ):
+	"""Does for a whole block of lines at once what strip_linesep()
+	and a newline do for each: carriage returns before a newline are
+	dropped, and a last line lacking a newline is given one.  If nl
+	is a carriage return, as in a Mac Eudora mailbox (see line_end()),
+	each one is made a newline first."""
+	if nl == '\r':
+		text = text.replace( '\r', '\n' )
+	text = text.replace( '\r\n', '\n' )
+	if '\r\n' in text:
+		text = re_crs_before_newline.sub( '\n', text )
+	if text and text[-1] != '\n':
+		text = text.rstrip( '\r' ) + '\n'
+	return text
+
+def map_mailbox( file ):
+	"""Returns a read-only memory map of the open mailbox file.  An
+	empty file can't be mapped, so an empty string stands in for it;
+	both support the find() and slicing that message_spans() uses."""
+	size = os.fstat( file.fileno() ).st_size
+	if size == 0:
+		return ''
+	return mmap.mmap( file.fileno(), size, access = mmap.ACCESS_READ )
+
+def message_spans( buf, start = 0, end = None, replies = None ):
+	"""
+	Finds the messages in the Eudora mailbox held in buf (a string or
+	a memory map of the file) between the offsets start and end.
+
+	Rather than matching re_message_start against every line, we use
+	the native find to jump from one line beginning with 'From' to the
+	next, and only run the date pattern on those candidates.
+
+	If a Replies object is passed in, the headers of each message
+	found are handed to it as we go, so that the In-Reply-To ids are
+	collected without a separate pass over the mailbox.
+
+	Returns a list of ( offset, length ) tuples, one per message.  As
+	with reading the mailbox line by line, anything before the first
+	'From ' line is treated as a message of its own.
+
+	Mac Eudora ends its lines with a carriage return alone; see
+	line_end().
+	"""
+	if end is None:
+		end = len( buf )
+	spans = []
+	if start >= end:
+		return spans
+
+	nl = line_end( buf, start, end )
+	msg_start = start
+	is_message = False
+	if buf.find( 'From', start, start + 4 ) == start:
+		candidate = start
+	else:
+		candidate = buf.find( nl + 'From', start, end )
+		if candidate != -1:
+			candidate = candidate + 1
+
+	while candidate != -1:
+		eol = buf.find( nl, candidate, end )
+		if eol == -1:
+			eol = end
+		else:
+			eol = eol + 1
+		if re_message_start.match( buf[candidate:eol] ):
+			if candidate > msg_start:
+				spans.append( ( msg_start, candidate - msg_start ) )
+				if replies and is_message:
+					replies.collect( buf, msg_start, candidate - msg_start, nl )
+			msg_start = candidate
+			is_message = True
+		candidate = buf.find( nl + 'From', eol - 1, end )
+		if candidate != -1:
+			candidate = candidate + 1
+
+	spans.append( ( msg_start, end - msg_start ) )
+	if replies and is_message:
+		replies.collect( buf, msg_start, end - msg_start, nl )
+	return spans
+
+def line_end( buf, start, end ):
+	"""The line separator of the mailbox in buf: a carriage return if
+	the first line between start and end ends with one not followed by
+	a newline, as in a Mac Eudora mailbox, otherwise a newline."""
+	eol = buf.find( '\n', start, end )
+	if eol == -1:
+		eol = end
+	cr = buf.find( '\r', start, eol )
+	if cr != -1 and cr + 1 < eol:
+		return '\r'
+	return '\n'
+
+def starts_message( buf, offset ):
+	"""True if a Eudora 'From ' line begins at offset in buf, after a
+	newline or, in a Mac Eudora mailbox, a carriage return."""
+	if offset > 0 and buf[offset - 1] not in '\r\n':
+		return False
+	eol = buf.find( '\n', offset )
+	if eol == -1:
+		eol = len( buf )
+	cr = buf.find( '\r', offset, eol )
+	if cr != -1:
+		eol = cr
+	return re_message_start.match( buf[offset:eol + 1] ) is not None
+
+def toc_message_spans( buf, toc_spans, replies = None ):
+	"""
+	Like message_spans(), but takes the message offsets and lengths
+	from the mailbox's toc (see TOC_Info.spans()) rather than
+	searching for them, so the body of a message is never looked at.
+
+	Each toc span is checked to begin with a 'From ' line and to end
+	where another one begins, or at the end of the mailbox.  Parts of
+	the mailbox not covered by a span that passes, whether because
+	the toc is out of date or is missing entries, are handed to
+	message_spans() instead.
+	"""
+	size = len( buf )
+	nl = line_end( buf, 0, size )
+	spans = []
+	pos = 0
+	for ( offset, length ) in toc_spans:
+		end = offset + length
+		if offset < pos or length <= 0 or end > size:
+			continue
+		if not starts_message( buf, offset ):
+			continue
+		if end < size and not starts_message( buf, end ):
+			continue
+		if offset > pos:
+			spans.extend( message_spans( buf, pos, offset, replies ) )
+		spans.append( ( offset, length ) )
+		if replies:
+			replies.collect( buf, offset, length, nl )
+		pos = end
+	if pos < size:
+		spans.extend( message_spans( buf, pos, size, replies ) )
+	return spans
+
+class TOC_Health:
+	"""
+	How well a mailbox's toc agrees with the mailbox, from the
+	( offset, length ) of each of its entries (see TOC_Info.spans()),
+	and whether it can be trusted.
+
+	Every entry should point at a 'From ' line and end where another
+	one begins, or at the end of the mailbox; no two should overlap;
+	and none should run past the end of the mailbox.  The entries are
+	taken in mailbox order, so that overlaps show up between
+	neighbours, and each boundary they share is only looked at once.
+
+	A toc missing some messages can still be trusted, since the rest
+	of the mailbox is searched for them anyway (see
+	toc_message_spans()), as can blank entries, which an empty
+	mailbox's toc may hold; a toc with any other problem is taken to
+	be stale, rebuilt against another mailbox, or corrupt, and its
+	status and priority info would likely land on the wrong messages.
+	"""
+	def __init__( self, buf, toc_spans ):
+		size = len( buf )
+		self.entries = len( toc_spans )
+		self.good = 0
+		self.blank = 0
+		self.bad_start = 0	# not at a 'From ' line
+		self.bad_end = 0	# not ending where a message begins
+		self.overlapping = 0
+		self.past_end = 0
+		self.uncovered = 0	# bytes of the mailbox in no entry
+
+		starts = {}
+		pos = 0
+		for ( offset, length ) in toc_spans:
+			if length <= 0:
+				self.blank += 1
+				continue
+			end = offset + length
+			if end > size:
+				self.past_end += 1
+				continue
+			if offset < pos:
+				self.overlapping += 1
+				continue
+			self.uncovered += offset - pos
+			pos = end
+			if offset not in starts:
+				starts[offset] = starts_message( buf, offset )
+			if not starts[offset]:
+				self.bad_start += 1
+				continue
+			if end < size:
+				if end not in starts:
+					starts[end] = starts_message( buf, end )
+				if not starts[end]:
+					self.bad_end += 1
+					continue
+			self.good += 1
+		self.uncovered += size - pos
+
+	def trusted( self ):
+		return not ( self.bad_start or self.bad_end
+				or self.overlapping or self.past_end )
+
+	def __str__( self ):
+		return ( '%d entries: %d good, %d blank, %d not at a message, '
+			'%d not ending at one, %d overlapping, %d past the end; '
+			'%d bytes of the mailbox in none' % ( self.entries,
+			self.good, self.blank, self.bad_start, self.bad_end,
+			self.overlapping, self.past_end, self.uncovered ) )
+
+re_headers_end = re.compile( r'\n\r*\n' )
+
 # SW
 class Replies:
 	"""
@@ -71,13 +289,18 @@ class Replies:
 	to the current message Message-ID.
 	Pine indicates that a message has been replied to by X-Status: A,
 
-	This reads through whole mailbox, makes dictionary of message ID's
-	found in In-Reply-To headers.
+	Makes dictionary of message ID's found in In-Reply-To headers.
+	Given a file, this reads through whole mailbox to do so.  Without
+	one, the headers of each message are handed to collect() instead,
+	normally by message_spans() while it locates the messages, so that
+	the mailbox only gets read once.
         
 	Note: Won't work if reply is in a different mailbox, or otherwise lost.
 	"""
-	def __init__( self, file ):
+	def __init__( self, file = None ):
 		self.replies = {}
+		if not file:
+			return
 		inheaders = False
 		# see below for why I don't use a for line in file loop here.
 		while True:
@@ -99,6 +322,34 @@ class Replies:
 							self.replies[line] = True
 		file.seek( 0 )
 
+	def collect( self, buf, offset, length, nl = '\n' ):
+		"""Records the In-Reply-To ids in the headers of the message
+		at offset in buf, which starts with its 'From ' line.  Only
+		the headers are looked at; they end at the first empty line.
+		nl is the mailbox's line separator; see line_end()."""
+		end = offset + length
+		start = buf.find( nl, offset, end )
+		if start == -1:
+			return
+		if nl == '\r':
+			headers_end = buf.find( '\r\r', start, end )
+			if headers_end != -1:
+				end = headers_end
+			headers = buf[start:end].replace( '\r', '\n' )
+		else:
+			headers_end = re_headers_end.search( buf, start, end )
+			if headers_end:
+				end = headers_end.start()
+			headers = buf[start:end]
+
+		i = headers.find( '\nIn-Reply-To:' )
+		while i != -1:
+			eol = headers.find( '\n', i + 1 )
+			if eol == -1:
+				eol = len( headers )
+			self.replies[headers[i + 13:eol].strip()] = True
+			i = headers.find( '\nIn-Reply-To:', eol )
+
 	def message_was_answered( self, message_id ):
 		if len( message_id ) > 0:
 			message_id = message_id.strip()
@@ -112,45 +363,48 @@ class Replies:
 
 # SW
 class TOC_Info:
-	"""Looks for a file ending in ".toc.txt" to find values of
+	"""Reads the Eudora '.toc' file for the mailbox to find values of
 	Status and X_PRIORITY headers.  See EudoraTOC.py.
 
-	The parsed toc file is text file that represents the contents of
-	the binary Eudora '.toc' file corresponding to the mailbox.
 	The Status info indicates whether the Eudora message was read or
 	not.
 
+	Where there is no toc file, but there is an AppleDouble file beside
+	the mailbox, as a Mac leaves, the toc is read from its resource fork.
+
 	The toc file keeps track of the message by a binary offset to
-	the beginning of the message in the mailbox file
+	the beginning of the message in the mailbox file, and info maps
+	that offset, as an integer, to the message's entry in the toc.
+	If read is false, the toc isn't read, as for one that's been
+	distrust()ed.
 	"""
-	def __init__( self, mbx_name ):
-		self.info = {}
-		offset = 0
-		status = ''
-		toc_file_name = mbx_name + ".toc.txt"
+	def __init__( self, mbx_name, read = True ):
+		if not read:
+			self.distrust()
+			return
+		toc_file_name = mbx_name + ".toc"
+		sidecar = AppleSingleDouble.sidecar( mbx_name )
 		try:
-			TOCFILE = open( toc_file_name )
-
-			# the theory here is that an 'offset:' line in the
-			# parsed toc file will always precede the other lines
-			# for that message
-			for line in TOCFILE:
-				if line.find( 'offset:' ) == 0:
-					offset = line.replace( 'offset:', '' ).strip()
-					self.info[offset] = {}
-				elif line.find( 'status:' ) == 0:
-					status = line.replace( 'status:', '' ).strip()
-					self.info[offset]['status'] = status
-				elif line.find( 'priority:' ) == 0:
-					pri = line.replace( 'priority:', '' ).strip()
-					self.info[offset]['priority'] = pri
-			TOCFILE.close()
-
-		except IOError, ( errno, strerror ):
+			if ( not os.path.exists( toc_file_name )
+					and os.path.exists( sidecar ) ):
+				toc_file_name = sidecar
+				self.toc = EudoraTOC.resource_toc( mbx_name )
+			else:
+				self.toc = EudoraTOC.TOC( toc_file_name )
+			self.info = self.toc.index()
+
+		except EudoraTOC.TOCError, e:
+			self.toc = None
 			self.info = None
 			if EudoraLog.verbose >= 0:
-				print( "Couldn't read parsed .toc file '" 
-					+ toc_file_name + "': " + strerror )
+				print( "Couldn't read .toc file '" 
+					+ toc_file_name + "': " + e.args )
+
+	def distrust( self ):
+		"""Drop the toc info, for a toc that doesn't agree with the
+		mailbox (see TOC_Health)."""
+		self.toc = None
+		self.info = None
 
 	def info_exists_for_msg_at( self, offset ):
 		try:
@@ -161,16 +415,23 @@ class TOC_Info:
 
 	def status_of_msg_at( self, offset ):
 		try:
-			return self.info[offset]['status']
+			return self.toc.status( self.info[offset] )
 		except KeyError:
 			return None
 
 	def priority_of_msg_at( self, offset ):
 		try:
-			return self.info[offset]['priority']
+			return self.toc.priority( self.info[offset] )
 		except KeyError:
 			return None
 
+	def spans( self ):
+		"""Returns the ( offset, length ) of each message the toc
+		knows about, in mailbox order."""
+		if self.info:
+			return self.toc.spans( self.info )
+		return []
+
 weekdays = ( 'Sun', 'Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat' )
 
 def fix_date( date ):
@@ -182,50 +443,68 @@ def fix_date( date ):
 	return string.join( d, ' ' )
 
 
+class Field( object ):
+	"""
+	One header line: lowercase-id, id, value.
+
+	The first is for searching by id, the second is to make id
+	output like the input.  Both are interned, as the same few
+	dozen ids turn up in every message of a mailbox.
+	"""
+
+	__slots__ = ( 'lcid', 'id', 'value' )
+
+	def __init__( self, id, value ):
+		self.id = intern( id )
+		self.lcid = intern( id.lower() )
+		self.value = value
+
 # SW
-class Header:
+class Header( object ):
 	"""
-	A list of mailbox headers.
+	A list of mailbox headers, as Field objects.
 	Implements case-insensitive searching (RFC 561 explicitly states
 	case of headers is undefined); keeps a mixed-case version for output.
 
 	A dictionary doesn't work for this because several header
-	lines can share the same key, e.g. 'Received:'.
-
-	Three fields used:
-		lowercase-id, id, value
-
-	The first is for searching by id, the second is to make id
-	output like the input.
+	lines can share the same key, e.g. 'Received:'.  The first
+	line with each lowercase-id is kept in a dictionary, though,
+	so that looking a header up doesn't mean searching the whole
+	list; messages with hundreds of Received: lines would otherwise
+	take quadratic time to clean.
 	"""
 
         ok_to_dup = ( 'received:', 'x400-received:', 'delivered-to:', 'x-mailer:',
                       'return-path:', 'sender:', 'mime-version:', 'precedence:',
                       'x-uidl:', 'content-transfer-encoding:', )
 
+	__slots__ = ( 'data', 'first', 'cleaned' )
+
 	def __init__( self ):
 		self.data = []
-		self.index = 0
+		self.first = {}
                 self.cleaned = False
 	
 	def __iter__( self ):
-		return self
+		for h in self.data:
+			yield ( h.id, h.value )
 
 	def __str__( self ):
-		return "\n".join([name + " " + value for (lcname, name, value) in self.data])
+		return "\n".join([h.id + " " + h.value for h in self.data])
 
 	def add( self, id, value ):
 		"""Will also accept un-parsed line"""
 		if not id or len( id ) == 0:
 			return
 		value = self.stripOffID( id, value )
-		self.data.append( [ id.lower(), id, value ] )
+		h = Field( id, value )
+		self.first.setdefault( h.lcid, h )
+		self.data.append( h )
 
 	def getValue( self, id ):
-		lcid = id.lower()
-		for h in self.data:
-			if h[0] == lcid:
-				return h[2]
+		h = self.first.get( id.lower() )
+		if h:
+			return h.value
 		return None
 
 	def stripOffID( self, id, line ):
@@ -243,22 +522,17 @@ class Header:
 		idlen = len( id )
 		if idlen == 0:
 			return
-		if self.getValue( id ):
-			lcid = id.lower()
-			for h in self.data:
-				if h[0] == lcid:
-					h[2] = self.stripOffID( id, value )
-					break
+		if self.getValue( id ) is not None:
+			self.first[id.lower()].value = self.stripOffID( id, value )
 		else:
 			self.add( id, value )
 
 	def removeValue( self, id ):
-		newlist = []
 		lcid = id.lower()
-		for h in self.data:
-			if h[0] != lcid:
-				newlist.append(h)
-		self.data = newlist
+		if not self.first.has_key( lcid ):
+			return
+		del self.first[lcid]
+		self.data = [ h for h in self.data if h.lcid != lcid ]
 
 	def replaceValue( self, id, value ):
 		self.removeValue(id)
@@ -270,24 +544,15 @@ class Header:
 		if len( self.data ) == 0:
 			return
 		additional = strip_linesep( additional )
-		self.data[-1][2] += os.linesep + '\t' + additional
+		self.data[-1].value += os.linesep + '\t' + additional
 
 	def emit( self, filehandle, exceptions = None ):
 		for h in self.data:
-			if not exceptions or h[0] not in exceptions:
-				filehandle.write( h[1] )
-				if h[0] != 'from ':
+			if not exceptions or h.lcid not in exceptions:
+				filehandle.write( h.id )
+				if h.lcid != 'from ':
 					filehandle.write( ' ' )
-				filehandle.write( h[2] + os.linesep )
-
-	def next( self ):
-		if self.index < len( self.data ):
-			val = ( self.data[self.index][1],
-				self.data[self.index][2] )
-			self.index = self.index + 1
-			return val
-		else:
-			raise StopIteration
+				filehandle.write( h.value + os.linesep )
 
         def add_line(self, line):
             """Parses a header line into a (key, value) tuple, trimming
@@ -492,12 +757,8 @@ class Header:
 
             # Pull status and priority info out of the '.toc' file
             if toc:
-                    # SW: Careful here: the backtick integer-to-string translation
-                    # will put an 'L' at the end of the number, but we need the
-                    # decimal version for a textual lookup in the dictionary.
-                    offset_str = "%d" % ( msg_offset, )
-                    if toc.info_exists_for_msg_at( offset_str ):
-                            status_in_toc = toc.status_of_msg_at( offset_str )
+                    if toc.info_exists_for_msg_at( msg_offset ):
+                            status_in_toc = toc.status_of_msg_at( msg_offset )
                             # See RFC 2076 for a discussion of Status header
                             if status_in_toc:
                                     hdr_status = self.getValue( 'Status:' )
@@ -506,7 +767,7 @@ class Header:
                                     else:
                                             hdr_status = status_in_toc
                                     self.setValue( 'Status:', hdr_status )
-                            priority = int( toc.priority_of_msg_at( offset_str ) )
+                            priority = toc.priority_of_msg_at( msg_offset )
                             if priority:
                                     # Kmail responds to this header
                                     self.setValue( 'X-Priority:', "%d" % ( priority, ) )
@@ -521,6 +782,6 @@ class Header:
                                             self.setValue( 'X-Status:', hpri )
                     else:
 			    pass
-                            # EudoraLog.log.warn( "No toc entry for message at offset " + offset_str)
+                            # EudoraLog.log.warn( "No toc entry for message at offset %d" % msg_offset )
 
             self.cleaned = True